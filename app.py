@@ -1,105 +1,953 @@
-from docling.document_converter import DocumentConverter
-from docling_core.types.doc import DocItemLabel
 import pandas as pd
 import io
-import gradio as gr
 import os
 import fitz  # PyMuPDF
 from PIL import Image
 from datetime import datetime
+import queue
+import asyncio
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import numpy as np
+import threading
+import time
+import random
+import uuid
+import contextvars
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv, find_dotenv
-import pinecone
-from pinecone import Pinecone
-import cohere
 
 _= load_dotenv(find_dotenv())
 
+TRACE_LOG_FILE = os.environ.get("TRACE_LOG_FILE", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_DEFINITIONS = {
+    'publica_stage_seconds': ('histogram', "Boru hattı aşamalarının süresi (saniye)"),
+    'publica_stage_errors_total': ('counter', "Hatayla biten aşama sayısı"),
+    'publica_requests_total': ('counter', "Tamamlanan çıkarma ve analiz istekleri"),
+    'publica_tokens_total': ('counter', "Gemini istem ve yanıt token sayısı"),
+    'publica_retrieved_documents_total': ('counter', "İsteme eklenmek üzere bulunan referans belgeleri"),
+    'publica_cache_requests_total': ('counter', "Önbellek sorguları (hit/miss)"),
+    'publica_extraction_pages_total': ('counter', "Çıkarma motoruna göre işlenen PDF sayfaları"),
+    'publica_cache_hit_ratio': ('gauge', "Süreç başından beri önbellek isabet oranı"),
+    'publica_converter_pool': ('gauge', "PDF dönüştürücü havuzu durumu"),
+    'publica_reference_index_progress': ('gauge', "Referans indekslemesinin ilerlemesi"),
+    'publica_page_cache': ('gauge', "Oturumların sayfa görüntüsü belleği"),
+    'publica_exports': ('gauge', "Süresi dolmamış CSV dışa aktarımları"),
+}
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+class Metrics:
+    """Sayaç ve gecikme histogramlarını bellekte tutar, Prometheus metin biçiminde sunar"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_collector(self, collector):
+        """Okuma anında (ad, etiketler, değer) göstergeleri üreten bir fonksiyon ekler"""
+        self._collectors.append(collector)
+
+    def counter_values(self, name):
+        with self._lock:
+            return {labels: value for (metric, labels), value in self._counters.items() if metric == name}
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in self._histograms.items()}
+        
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                print(f"Metrik toplama hatası: {e}")
+        
+        lines = []
+        for name, (kind, help_text) in METRIC_DEFINITIONS.items():
+            source = histograms if kind == 'histogram' else counters if kind == 'counter' else gauges
+            series = sorted((labels, value) for (metric, labels), value in source.items() if metric == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(self.buckets, value['buckets']):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def cache_hit_ratios():
+    totals = {}
+    for labels, value in metrics.counter_values('publica_cache_requests_total').items():
+        labels = dict(labels)
+        hits, lookups = totals.get(labels['cache'], (0, 0))
+        totals[labels['cache']] = (hits + (value if labels['result'] == 'hit' else 0), lookups + value)
+    return [
+        ('publica_cache_hit_ratio', {'cache': cache}, hits / lookups)
+        for cache, (hits, lookups) in totals.items() if lookups
+    ]
+
+metrics.add_collector(cache_hit_ratios)
+
+def record_cache_lookup(cache, hits=0, misses=0):
+    if hits:
+        metrics.inc('publica_cache_requests_total', hits, cache=cache, result='hit')
+    if misses:
+        metrics.inc('publica_cache_requests_total', misses, cache=cache, result='miss')
+
+_current_trace = contextvars.ContextVar("publica_trace", default=None)
+_trace_log_lock = threading.Lock()
+
+class Trace:
+    """Tek bir isteğin aşama sürelerini toplar; TRACE_LOG_FILE ayarlıysa JSON satırı olarak yazar"""
+
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.spans = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, started_at, duration, attributes=None, error=None):
+        span = {'stage': stage, 'offset_s': round(started_at - self.started_at, 4), 'duration_s': round(duration, 4)}
+        if attributes:
+            span.update(attributes)
+        if error:
+            span['error'] = error
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def activate(self):
+        """Bu blokta (ve oradan başlatılan to_thread çağrılarında) açılan aşamalar bu izlemeye eklenir"""
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def finish(self, **attributes):
+        self.attributes.update(attributes)
+        metrics.inc('publica_requests_total', kind=self.name, status=self.attributes.get('status', 'ok'))
+        if not TRACE_LOG_FILE:
+            return
+        record = {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='milliseconds'),
+            'duration_s': round(time.perf_counter() - self._start, 4),
+            'attributes': self.attributes,
+            'spans': self.spans,
+        }
+        try:
+            with _trace_log_lock:
+                os.makedirs(os.path.dirname(TRACE_LOG_FILE) or ".", exist_ok=True)
+                with open(TRACE_LOG_FILE, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"İzleme kaydı yazılamadı: {e}")
+
+def record_span(stage, started_at, duration, attributes=None, error=None):
+    metrics.observe('publica_stage_seconds', duration, stage=stage)
+    if error:
+        metrics.inc('publica_stage_errors_total', stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, started_at, duration, attributes, error)
+
+@contextmanager
+def span(stage, **attributes):
+    """Aşama süresini histograma ve varsa etkin izlemeye ekler; dönen sözlüğe ek bilgi yazılabilir"""
+    started_at = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record_span(stage, started_at, time.perf_counter() - start, attributes, error)
+
+@contextmanager
+def trace_request(name, **attributes):
+    """İstek düzeyinde izleme başlatır; zaten bir izleme içindeyse onu kullanır"""
+    current = _current_trace.get()
+    if current is not None:
+        yield current
+        return
+    
+    trace = Trace(name, **attributes)
+    try:
+        with trace.activate():
+            yield trace
+    except Exception as e:
+        trace.finish(status='error', error=str(e))
+        raise
+    else:
+        trace.finish()
+
+# Docling dönüşümü CPU yoğun; eşzamanlı çıkarma sayısı çekirdek sayısına bağlı
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+CONVERTER_POOL_SIZE = int(os.environ.get("CONVERTER_POOL_SIZE", str(EXTRACTION_WORKERS)))
+# Uzun PDF'ler sayfa aralıklarına bölünüp bu kadar işçi süreçte paralel dönüştürülür
+PDF_CONVERSION_PROCESSES = int(os.environ.get("PDF_CONVERSION_PROCESSES", str(EXTRACTION_WORKERS)))
+PDF_PAGES_PER_CHUNK = int(os.environ.get("PDF_PAGES_PER_CHUNK", "4"))
+
+class ConverterPool:
+    """Önceden yüklenmiş DocumentConverter nesnelerini paylaştıran süreç geneli havuz"""
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _create(self):
+        # Docling ve modelleri ağır; yalnızca ilk dönüştürücü gerektiğinde yüklenir
+        from docling.document_converter import DocumentConverter
+        from docling.datamodel.base_models import InputFormat
+        
+        converter = DocumentConverter()
+        # Model yüklemesini ilk istekte değil havuza eklenirken yap
+        converter.initialize_pipeline(InputFormat.PDF)
+        return converter
+
+    def warm_up(self):
+        """Havuzu tam kapasiteye kadar doldurur"""
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    return
+                self._created += 1
+            try:
+                converter = self._create()
+            except Exception:
+                # Başarısız yükleme yer tutmasın; yoksa sonraki acquire() boş kuyrukta sonsuza kadar bekler
+                with self._lock:
+                    self._created -= 1
+                raise
+            self._idle.put(converter)
+
+    def acquire(self):
+        start = time.perf_counter()
+        try:
+            converter = self._idle.get_nowait()
+        except queue.Empty:
+            converter = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create_new = True
+                else:
+                    create_new = False
+            if create_new:
+                try:
+                    converter = self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                converter = self._idle.get()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._wait_count += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return converter
+
+    def release(self, converter):
+        self._idle.put(converter)
+
+    @contextmanager
+    def converter(self):
+        converter = self.acquire()
+        try:
+            yield converter
+        finally:
+            self.release(converter)
+
+    def stats(self):
+        """Havuz doluluğu ve bekleme süresi metriklerini döndürür"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'idle': self._idle.qsize(),
+                'acquisitions': self._wait_count,
+                'wait_total_s': self._wait_total,
+                'wait_avg_s': self._wait_total / self._wait_count if self._wait_count else 0.0,
+                'wait_max_s': self._wait_max,
+            }
+
+converter_pool = ConverterPool(CONVERTER_POOL_SIZE)
+
+def converter_pool_gauges():
+    stats = converter_pool.stats()
+    return [
+        ('publica_converter_pool', {'field': field}, stats[field])
+        for field in ('size', 'created', 'idle', 'acquisitions', 'wait_avg_s', 'wait_max_s')
+    ]
+
+metrics.add_collector(converter_pool_gauges)
+
+PAGE_RENDER_ZOOM = 1.5
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", "5"))
+MAX_OPEN_DOCUMENTS = int(os.environ.get("MAX_OPEN_DOCUMENTS", "32"))
+# Tüm oturumların sıkıştırılmış sayfa görüntüleri için ortak bellek sınırı
+PAGE_MEMORY_BUDGET_BYTES = int(os.environ.get("PAGE_MEMORY_BUDGET_MB", "64")) * 1024 * 1024
+SESSION_IDLE_SECONDS = int(os.environ.get("SESSION_IDLE_MINUTES", "30")) * 60
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join("temp", "exports"))
+EXPORT_TTL_SECONDS = int(os.environ.get("EXPORT_TTL_MINUTES", "60")) * 60
+
+HEADER_KEYWORDS = ['tarih', 'tahlil', 'sonuç', 'birimi', 'referans']
+
+EXTRACTION_CACHE_DIR = os.environ.get("EXTRACTION_CACHE_DIR", os.path.join("cache", "extraction"))
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get("EXTRACTION_CACHE_MAX_MB", "256")) * 1024 * 1024
+# Çıktıyı etkileyen her ayar buraya eklenmeli; değişince eski önbellek kayıtları kullanılmaz
+# auto: metin katmanı, güveni düşük sayfalar için docling; docling: her sayfa docling; text: yalnızca metin katmanı
+EXTRACTION_ENGINE = os.environ.get("EXTRACTION_ENGINE", "auto").lower()
+TEXT_LAYER_MIN_WORDS = 5
+TEXT_LAYER_MIN_COVERAGE = 0.9
+TEXT_LAYER_MIN_FILLED = 0.9
+EXTRACTION_SETTINGS = {
+    'engine': EXTRACTION_ENGINE,
+    'labels': ['table'],
+    'enable_chart_tables': False,
+    'text_layer': [TEXT_LAYER_MIN_WORDS, TEXT_LAYER_MIN_COVERAGE, TEXT_LAYER_MIN_FILLED],
+    'version': 3,
+}
+_extraction_cache_lock = threading.Lock()
+
+def file_sha256(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def extraction_cache_key(report_hash):
+    """PDF içerik özeti ve çıkarma ayarlarından önbellek anahtarı üretir"""
+    settings = json.dumps(EXTRACTION_SETTINGS, sort_keys=True)
+    settings_hash = hashlib.sha256(settings.encode('utf-8')).hexdigest()[:16]
+    return f"{report_hash}-{settings_hash}"
+
+def load_cached_extraction(key):
+    cache_file = os.path.join(EXTRACTION_CACHE_DIR, f"{key}.parquet")
+    if not os.path.exists(cache_file):
+        return None
+    
+    try:
+        df = pd.read_parquet(cache_file)
+        # LRU için son erişim zamanını güncelle
+        os.utime(cache_file)
+        return df
+    except Exception as e:
+        print(f"Önbellek okuma hatası: {e}")
+        return None
+
+def store_cached_extraction(key, df):
+    try:
+        os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+        cache_file = os.path.join(EXTRACTION_CACHE_DIR, f"{key}.parquet")
+        tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        df.to_parquet(tmp_file, compression="zstd")
+        os.replace(tmp_file, cache_file)
+        evict_extraction_cache()
+    except Exception as e:
+        print(f"Önbellek yazma hatası: {e}")
+
+def evict_extraction_cache():
+    """Önbellek boyut sınırını aşınca en uzun süre kullanılmayan kayıtları siler"""
+    with _extraction_cache_lock:
+        entries = []
+        for entry in os.scandir(EXTRACTION_CACHE_DIR):
+            if entry.name.endswith('.parquet'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= EXTRACTION_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+def pixmap_to_image(pix):
+    """PNG kodlama/çözme yapmadan pixmap'ten doğrudan PIL görüntüsü oluşturur"""
+    mode = "RGBA" if pix.alpha else "RGB"
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+def render_page(doc, page_num):
+    page = doc.load_page(page_num)
+    mat = fitz.Matrix(PAGE_RENDER_ZOOM, PAGE_RENDER_ZOOM)
+    return pixmap_to_image(page.get_pixmap(matrix=mat))
+
 def get_pdf_pages(file_path):
     if not file_path or not os.path.exists(file_path):
         return []
     
     try:
         doc = fitz.open(file_path)
-        pages = []
-        
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            mat = fitz.Matrix(1.5, 1.5)  # 1.5x zoom
-            pix = page.get_pixmap(matrix=mat)
-            img_data = pix.tobytes("png")
-            
-            img = Image.open(io.BytesIO(img_data))
-            pages.append(img)
-        
+        pages = [render_page(doc, page_num) for page_num in range(len(doc))]
         doc.close()
         return pages
     except Exception as e:
         print(f"PDF sayfa oluşturma hatası: {e}")
         return []
 
-def process_pdf(file_path):
+def encode_page(img):
+    """Sayfayı bellekte ham bitmap yerine kayıpsız WebP olarak tutmak için kodlar"""
+    buffer = io.BytesIO()
+    # method=0 en hızlı sıkıştırma; metin ağırlıklı sayfalarda ham boyutun ~%2'si
+    img.save(buffer, format="WEBP", lossless=True, method=0)
+    return buffer.getvalue()
+
+def decode_page(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+class PdfPageRenderer:
+    """Sayfaları istek üzerine çizer, sıkıştırılmış hâlde ortak bir bellek bütçesinde tutar ve komşu sayfaları önceden hazırlar"""
+
+    def __init__(self, cache_size, max_documents, memory_budget, idle_seconds):
+        self.cache_size = max(1, cache_size)
+        self.max_documents = max(1, max_documents)
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+        self._documents = OrderedDict()
+        # Aynı dosyayı (ör. örnek PDF) görüntüleyen oturumlar; belge yalnızca sonuncusu bırakınca kapanır
+        self._holders = {}
+        # Tüm oturumların sayfaları tek LRU'da; (belge anahtarı, sayfa) -> WebP baytları
+        self._pages = OrderedDict()
+        self._page_bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-prefetch")
+
+    def _document(self, file_path):
+        key = (file_path, os.path.getmtime(file_path))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._documents.get(key)
+            if entry is None:
+                entry = {
+                    'key': key,
+                    'doc': fitz.open(file_path),
+                    'lock': threading.Lock(),
+                    'pages': OrderedDict(),
+                    'last_used': now,
+                }
+                self._documents[key] = entry
+            else:
+                self._documents.move_to_end(key)
+                entry['last_used'] = now
+            
+            evicted = self._drop_idle(now)
+            while len(self._documents) > self.max_documents:
+                evicted.append(self._drop_document(next(iter(self._documents))))
+        
+        self._close(evicted)
+        return entry
+
+    def _drop_document(self, key):
+        # self._lock tutulurken çağrılır
+        entry = self._documents.pop(key)
+        for page_num in entry['pages']:
+            self._page_bytes -= len(self._pages.pop((key, page_num)))
+        self._evictions += len(entry['pages'])
+        entry['pages'].clear()
+        return entry
+
+    def _drop_idle(self, now):
+        idle = [key for key, entry in self._documents.items() if now - entry['last_used'] > self.idle_seconds]
+        return [self._drop_document(key) for key in idle]
+
+    def _close(self, entries):
+        # Belge kilitleri self._lock dışında alınır; kilit sırası her zaman belge -> genel
+        for entry in entries:
+            with entry['lock']:
+                entry['doc'].close()
+
+    def _evict_page(self, doc_key, page_num):
+        data = self._pages.pop((doc_key, page_num))
+        del self._documents[doc_key]['pages'][page_num]
+        self._page_bytes -= len(data)
+        self._evictions += 1
+
+    def _cached(self, entry, page_num):
+        with self._lock:
+            data = self._pages.get((entry['key'], page_num))
+            if data is not None:
+                self._pages.move_to_end((entry['key'], page_num))
+                entry['pages'].move_to_end(page_num)
+            return data
+
+    def _store(self, entry, page_num, data):
+        with self._lock:
+            page_key = (entry['key'], page_num)
+            # Çizim sürerken belge boşta kaldığı için kapatılmış olabilir
+            if entry['key'] not in self._documents or page_key in self._pages:
+                return
+            
+            self._pages[page_key] = data
+            entry['pages'][page_num] = None
+            self._page_bytes += len(data)
+            if len(entry['pages']) > self.cache_size:
+                self._evict_page(entry['key'], next(iter(entry['pages'])))
+            while self._page_bytes > self.memory_budget and len(self._pages) > 1:
+                self._evict_page(*next(iter(self._pages)))
+
+    def page_count(self, file_path):
+        entry = self._document(file_path)
+        with entry['lock']:
+            return len(entry['doc'])
+
+    def _render(self, entry, page_num, count_lookup=True):
+        with entry['lock']:
+            data = self._cached(entry, page_num)
+            if data is not None:
+                if count_lookup:
+                    record_cache_lookup('page', hits=1)
+                return data
+            if entry['doc'].is_closed:
+                return None
+            
+            if count_lookup:
+                record_cache_lookup('page', misses=1)
+            with span('render', page=page_num):
+                data = encode_page(render_page(entry['doc'], page_num))
+            self._store(entry, page_num, data)
+            return data
+
+    def get_page(self, file_path, page_num, prefetch=True):
+        entry = self._document(file_path)
+        data = self._render(entry, page_num)
+        
+        if prefetch:
+            with entry['lock']:
+                total = 0 if entry['doc'].is_closed else len(entry['doc'])
+            for neighbor in (page_num + 1, page_num - 1):
+                if 0 <= neighbor < total:
+                    self._prefetcher.submit(self._prefetch, entry, neighbor)
+        return decode_page(data) if data is not None else None
+
+    def _prefetch(self, entry, page_num):
+        try:
+            # Önceden hazırlama isabet oranına sayılmaz; oran kullanıcının beklediği sayfaları yansıtır
+            self._render(entry, page_num, count_lookup=False)
+        except Exception as e:
+            print(f"Sayfa önceden hazırlanamadı: {e}")
+
+    def acquire(self, file_path, holder):
+        """Oturumu belgenin kullanıcıları arasına ekler"""
+        with self._lock:
+            self._holders.setdefault(file_path, set()).add(holder)
+
+    def release(self, file_path, holder):
+        """Oturum kapanınca onu kullanıcılardan çıkarır; belgeyi kullanan başka oturum yoksa sayfaları ve dosya tanıtıcısını bırakır"""
+        with self._lock:
+            holders = self._holders.get(file_path, set())
+            holders.discard(holder)
+            if holders:
+                return
+            self._holders.pop(file_path, None)
+            keys = [key for key in self._documents if key[0] == file_path]
+            evicted = [self._drop_document(key) for key in keys]
+        self._close(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'bytes': self._page_bytes,
+                'budget_bytes': self.memory_budget,
+                'pages': len(self._pages),
+                'documents': len(self._documents),
+                'evictions': self._evictions,
+            }
+
+page_renderer = PdfPageRenderer(PAGE_CACHE_SIZE, MAX_OPEN_DOCUMENTS, PAGE_MEMORY_BUDGET_BYTES, SESSION_IDLE_SECONDS)
+
+def page_cache_gauges():
+    stats = page_renderer.stats()
+    return [('publica_page_cache', {'field': field}, value) for field, value in stats.items()]
+
+metrics.add_collector(page_cache_gauges)
+
+def cleanup_exports(max_age=None):
+    """Süresi dolan CSV dışa aktarımlarını siler"""
+    max_age = EXPORT_TTL_SECONDS if max_age is None else max_age
+    if not os.path.isdir(EXPORT_DIR):
+        return 0
+    
+    removed = 0
+    now = time.time()
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            # Başka bir işçi aynı dosyayı silmiş olabilir
+            pass
+    return removed
+
+def export_csv(df):
+    """Tabloyu benzersiz adlı bir CSV dosyasına yazar; eşzamanlı kullanıcılar birbirinin dosyasını ezmez"""
+    cleanup_exports()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    csv_file = os.path.join(EXPORT_DIR, f"lab_degerleri_{timestamp}_{uuid.uuid4().hex[:8]}.csv")
+    df.to_csv(csv_file, index=False, encoding='utf-8-sig')
+    return csv_file
+
+def export_gauges():
+    files, size = 0, 0
+    if os.path.isdir(EXPORT_DIR):
+        for entry in os.scandir(EXPORT_DIR):
+            if entry.is_file():
+                files += 1
+                size += entry.stat().st_size
+    return [
+        ('publica_exports', {'field': 'files'}, files),
+        ('publica_exports', {'field': 'bytes'}, size),
+    ]
+
+metrics.add_collector(export_gauges)
+
+def process_pdf(file_path, patient_id=None):
+    """PDF'ten laboratuvar tablosunu çıkarır; hasta kimliği verilirse sonuçları o hastanın geçmişine ekler"""
     if not file_path or not os.path.exists(file_path):
         return pd.DataFrame(), "PDF dosyası bulunamadı"
     
-    try:
-        converter = DocumentConverter()
-        doc = converter.convert(file_path).document
-        
-        markdown_content = doc.export_to_markdown(
-            labels={DocItemLabel.TABLE},  # Sadece tabloları dahil et
-            image_placeholder="",  # Resim placeholder'ını boş bırak
-            enable_chart_tables=False,  # Grafik tablolarını devre dışı bırak
-        )
-        
-        temp_dir = "temp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-        
-        temp_md_file = os.path.join(temp_dir, "temp_tables.md")
-        with open(temp_md_file, "w", encoding="utf-8") as f:
-            f.write(markdown_content)
-        
-        df = markdown_to_dataframe(temp_md_file)
-        
-        if os.path.exists(temp_md_file):
-            os.remove(temp_md_file)
-        
-        return df, "PDF başarıyla işlendi"
-        
-    except Exception as e:
-        return pd.DataFrame(), f"Hata: {str(e)}"
+    with trace_request('extraction', file=os.path.basename(file_path)) as trace:
+        try:
+            report_hash = file_sha256(file_path)
+            cache_key = extraction_cache_key(report_hash)
+            cached_df = load_cached_extraction(cache_key)
+            record_cache_lookup('extraction', hits=int(cached_df is not None), misses=int(cached_df is None))
+            if cached_df is not None:
+                trace.attributes.update(cached=True, rows=len(cached_df))
+                if patient_id:
+                    ingest_report(patient_id, report_hash, cached_df, os.path.basename(file_path))
+                return cached_df, "PDF başarıyla işlendi"
+            
+            tables = extract_pdf_tables(file_path)
+            
+            with span('table_parse') as info:
+                df = stitch_tables(tables)
+                info['rows'] = len(df)
+            
+            if not df.empty:
+                store_cached_extraction(cache_key, df)
+                if patient_id:
+                    ingest_report(patient_id, report_hash, df, os.path.basename(file_path))
+            
+            trace.attributes.update(cached=False, rows=len(df))
+            return df, "PDF başarıyla işlendi"
+            
+        except Exception as e:
+            trace.attributes.update(status='error', error=str(e))
+            return pd.DataFrame(), f"Hata: {str(e)}"
+
+def page_ranges(pages, pages_per_chunk):
+    """1'den başlayan sayfa numaralarını ardışık, iki ucu dahil aralıklara böler (docling page_range biçimi)"""
+    pages_per_chunk = max(1, pages_per_chunk)
+    ranges = []
+    for page in sorted(pages):
+        if ranges and page == ranges[-1][1] + 1 and page - ranges[-1][0] < pages_per_chunk:
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+def convert_page_range(file_path, first_page, last_page):
+    """İşçi süreçte çalışır: sayfa aralığını dönüştürüp tablo hücrelerini döndürür"""
+    with converter_pool.converter() as converter:
+        doc = converter.convert(file_path, page_range=(first_page, last_page)).document
+    return table_grids(doc)
+
+def warm_up_conversion_worker():
+    global converter_pool
+    # İşçi aynı anda tek aralık dönüştürür; miras kalan CONVERTER_POOL_SIZE kadar model kopyası yüklemesin
+    converter_pool = ConverterPool(1)
+    converter_pool.warm_up()
 
-def merge_tables(markdown_text):
-    lines = markdown_text.split('\n')
-    table_lines = []
-    header_found = False
+_conversion_executor = None
+_conversion_executor_lock = threading.Lock()
+
+def discard_conversion_executor(executor):
+    """Bozulan süreç havuzunu bırakır; sonraki dönüşüm yeni bir havuz başlatır"""
+    global _conversion_executor
+    with _conversion_executor_lock:
+        if _conversion_executor is executor:
+            _conversion_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def get_conversion_executor():
+    """Sayfa aralıklarını dönüştüren süreç havuzunu ilk kullanımda başlatır"""
+    global _conversion_executor
+    with _conversion_executor_lock:
+        if _conversion_executor is None:
+            _conversion_executor = ProcessPoolExecutor(
+                max_workers=PDF_CONVERSION_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                # Her işçi kendi dönüştürücüsünü başlarken yükler
+                initializer=warm_up_conversion_worker,
+            )
+        return _conversion_executor
+
+def convert_page_ranges(file_path, ranges):
+    """Her sayfa aralığının tablolarını aralıkların sırasıyla döndürür; birden çok aralık paralel dönüştürülür"""
+    if not ranges:
+        return []
     
-    for line in lines:
-        if line.strip().startswith('|') and line.strip().endswith('|'):
-            if '---' not in line:
-                if not header_found:
-                    table_lines.append(line)
-                    header_found = True
-                else:
-                    # Eğer sütun sayısı aynıysa ve içerik başlık gibi görünüyorsa atla
-                    if line.count('|') == table_lines[0].count('|'):
-                        continue
-                    else:
-                        table_lines.append(line)
+    page_count = sum(last - first + 1 for first, last in ranges)
+    metrics.inc('publica_extraction_pages_total', page_count, engine='docling')
+    if PDF_CONVERSION_PROCESSES <= 1 or len(ranges) <= 1:
+        with span('converter_wait'):
+            converter = converter_pool.acquire()
+        try:
+            with span('docling', pages=page_count, chunks=len(ranges)):
+                return [
+                    table_grids(converter.convert(file_path, page_range=(first, last)).document)
+                    for first, last in ranges
+                ]
+        finally:
+            converter_pool.release(converter)
     
-    if table_lines:
-        header = table_lines[0]
-        data_rows = table_lines[1:]
-        
-        merged_table = header + '\n'
-        merged_table += '|' + '---|' * (header.count('|') - 1) + '\n'
-        merged_table += '\n'.join(data_rows)
+    with span('docling', pages=page_count, chunks=len(ranges)):
+        executor = get_conversion_executor()
+        try:
+            futures = [executor.submit(convert_page_range, file_path, first, last) for first, last in ranges]
+            # Parçalar gönderildikleri sırayla toplanır; sonuç sıralı dönüşümle aynıdır
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            # Başlatıcısı hata veren veya çöken işçi havuzu bir daha kullanılamaz
+            discard_conversion_executor(executor)
+            raise
+
+def conversion_chunk_size(page_count):
+    # Tek süreçte bölmenin faydası yok; belge tek seferde dönüştürülür
+    return PDF_PAGES_PER_CHUNK if PDF_CONVERSION_PROCESSES > 1 else page_count
+
+def convert_pdf_tables(file_path):
+    """PDF tablolarını sayfa sırasıyla döndürür; uzun belgeleri sayfa aralıklarına bölüp paralel dönüştürür"""
+    with fitz.open(file_path) as pdf:
+        page_count = len(pdf)
+    
+    ranges = page_ranges(range(1, page_count + 1), conversion_chunk_size(page_count))
+    return [table for tables in convert_page_ranges(file_path, ranges) for table in tables]
+
+def text_layer_page_tables(page, expected_width=None):
+    """Sayfanın tablolarını metin katmanından çıkarır; sonuç güvenilir değilse None döndürür"""
+    words = page.get_text("words")
+    if len(words) < TEXT_LAYER_MIN_WORDS:
+        # Taranmış sayfa: metin katmanı yok
+        return None
+    if any('\ufffd' in word[4] for word in words):
+        # Eşlenemeyen karakterler: yazı tipi kodlaması bozuk
+        return None
+    
+    found = page.find_tables().tables
+    if not found:
+        return None
+    
+    tables = []
+    for table in found:
+        rows = [[normalize_cell_text(cell) for cell in row] for row in table.extract()]
+        width = len(rows[0]) if rows else 0
+        if width < 3 or (expected_width and width != expected_width and not is_header_row(rows[0])):
+            return None
         
-        return merged_table
-    else:
-        return markdown_text
+        data_rows = [row for row in rows if any(row) and not is_header_row(row)]
+        filled = sum(1 for row in data_rows if sum(1 for cell in row if cell) >= 2)
+        if data_rows and filled / len(data_rows) < TEXT_LAYER_MIN_FILLED:
+            return None
+        tables.append(rows)
+    
+    # Tablonun üstündeki sayfa başlığı hariç, kelimelerin neredeyse tamamı bir tablonun içinde olmalı
+    table_top = min(table.bbox[1] for table in found)
+    boxes = [fitz.Rect(table.bbox) for table in found]
+    body_words = [word for word in words if (word[1] + word[3]) / 2 >= table_top]
+    covered = sum(
+        1 for word in body_words
+        if any(box.contains(fitz.Point((word[0] + word[2]) / 2, (word[1] + word[3]) / 2)) for box in boxes)
+    )
+    if body_words and covered / len(body_words) < TEXT_LAYER_MIN_COVERAGE:
+        return None
+    return tables
+
+def text_layer_tables(file_path):
+    """Her sayfa için metin katmanındaki tabloları veya docling gerektiren sayfalar için None döndürür"""
+    page_tables = []
+    expected_width = None
+    with fitz.open(file_path) as pdf:
+        for page in pdf:
+            try:
+                tables = text_layer_page_tables(page, expected_width)
+            except Exception as e:
+                print(f"Metin katmanı okunamadı (sayfa {page.number + 1}): {e}")
+                tables = None
+            if tables and expected_width is None:
+                expected_width = len(tables[0][0])
+            page_tables.append(tables)
+    return page_tables
+
+def extract_pdf_tables(file_path):
+    """PDF tablolarını sayfa sırasıyla döndürür; metin katmanı yetersiz kalan sayfalar docling'e düşer"""
+    if EXTRACTION_ENGINE == 'docling':
+        return convert_pdf_tables(file_path)
+    
+    with span('text_layer') as info:
+        page_tables = text_layer_tables(file_path)
+        fallback_pages = [page_num + 1 for page_num, tables in enumerate(page_tables) if tables is None]
+        info.update(pages=len(page_tables), fallback_pages=len(fallback_pages))
+    metrics.inc('publica_extraction_pages_total', len(page_tables) - len(fallback_pages), engine='text')
+    
+    if fallback_pages and EXTRACTION_ENGINE != 'text':
+        ranges = page_ranges(fallback_pages, conversion_chunk_size(len(page_tables)))
+        for (first, last), tables in zip(ranges, convert_page_ranges(file_path, ranges)):
+            # Aralığın tabloları ilk sayfasına yazılır; sayfa sırası korunur
+            page_tables[first - 1] = tables
+            for page_num in range(first, last):
+                page_tables[page_num] = []
+    
+    return [table for tables in page_tables if tables for table in tables]
+
+def export_tables_markdown(doc):
+    from docling_core.types.doc import DocItemLabel
+    
+    return doc.export_to_markdown(
+        labels={DocItemLabel.TABLE},  # Sadece tabloları dahil et
+        image_placeholder="",  # Resim placeholder'ını boş bırak
+        enable_chart_tables=False,  # Grafik tablolarını devre dışı bırak
+    )
+
+def is_header_row(cells):
+    """Satırın tekrar eden tablo başlığı olup olmadığını kontrol eder"""
+    text = " ".join(cells).lower()
+    return any(word in text for word in HEADER_KEYWORDS)
+
+def normalize_cell_text(text):
+    """Hücre içindeki satır sonlarını ve fazla boşlukları tek boşluğa indirir"""
+    return " ".join(str(text).split()) if text is not None else ""
+
+def table_grids(doc):
+    """Docling tablolarını süreçler arasında taşınabilen hücre metni listelerine çevirir"""
+    return [
+        [[normalize_cell_text(cell.text) for cell in grid_row] for grid_row in table.data.grid]
+        for table in doc.tables
+    ]
+
+def tables_to_dataframe(doc):
+    """Docling tablo hücrelerinden doğrudan bellekte DataFrame oluşturur"""
+    return stitch_tables(table_grids(doc))
+
+def stitch_tables(tables):
+    """Sayfa sayfa gelen tabloları tek tabloda birleştirir; her sayfada tekrarlanan başlıkları atar"""
+    header = None
+    rows = []
+    
+    for table in tables:
+        for cells in table:
+            if not any(cells):
+                continue
+            if header is None:
+                header = cells
+            elif len(cells) == len(header) and not is_header_row(cells):
+                rows.append(cells)
+    
+    if not header or not rows:
+        return pd.DataFrame()
+    
+    df = pd.DataFrame(rows, columns=header)
+    df = df.replace('', pd.NA).dropna(how='all')
+    return type_lab_columns(df)
+
+def lab_column_roles(df):
+    """Tablo başlıklarını test/sonuç/birim/referans/tarih rollerine eşler"""
+    roles = {}
+    for col in df.columns:
+        name = str(col).lower()
+        if 'tarih' in name:
+            roles.setdefault('date', col)
+        elif 'tahlil' in name or 'test' in name:
+            roles.setdefault('test', col)
+        elif 'birim' in name:
+            roles.setdefault('unit', col)
+        elif 'referans' in name:
+            roles.setdefault('reference', col)
+        elif 'sonuç' in name or 'değer' in name:
+            roles.setdefault('result', col)
+    return roles
+
+def type_lab_columns(df):
+    roles = lab_column_roles(df)
+    for role in ('test', 'result', 'reference', 'date'):
+        if role in roles:
+            df[roles[role]] = df[roles[role]].astype('string')
+    if 'unit' in roles:
+        # Birimler az sayıda farklı değer içerir
+        df[roles['unit']] = df[roles['unit']].astype('string').astype('category')
+    return df
 
 def markdown_to_dataframe(markdown_file):
     with open(markdown_file, 'r', encoding='utf-8') as f:
@@ -114,7 +962,7 @@ def markdown_to_dataframe(markdown_file):
             if header is None:
                 header = line
             else:
-                if not any(word in line.lower() for word in ['tarih', 'tahlil', 'sonuç', 'birimi', 'referans']):
+                if not any(word in line.lower() for word in HEADER_KEYWORDS):
                     all_data_rows.append(line)
     
     if header and all_data_rows:
@@ -132,163 +980,1700 @@ def markdown_to_dataframe(markdown_file):
     else:
         return pd.DataFrame()
 
-def get_gemini_embedding(text):
-    try:
-        client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-        
-        result = client.models.embed_content(
-            model="gemini-embedding-001",
-            contents=text,
-            config=types.EmbedContentConfig(output_dimensionality=768)
+SERVICE_TIMEOUT_SECONDS = float(os.environ.get("SERVICE_TIMEOUT_SECONDS", "60"))
+SERVICE_MAX_RETRIES = int(os.environ.get("SERVICE_MAX_RETRIES", "4"))
+SERVICE_RETRY_BASE_SECONDS = float(os.environ.get("SERVICE_RETRY_BASE_SECONDS", "0.5"))
+SERVICE_RETRY_MAX_SECONDS = float(os.environ.get("SERVICE_RETRY_MAX_SECONDS", "20"))
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class ServiceClients:
+    """Gemini, Pinecone ve Cohere istemcilerini bir kez oluşturup bağlantı havuzlarıyla paylaştırır"""
+
+    def __init__(self):
+        self._clients = {}
+        self._factories = {
+            'gemini': self._create_gemini,
+            'pinecone': self._create_pinecone,
+            'cohere': self._create_cohere,
+        }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create_gemini():
+        http_options = types.HttpOptions(
+            timeout=int(SERVICE_TIMEOUT_SECONDS * 1000),
+            base_url=os.environ.get("GEMINI_BASE_URL") or None,
         )
+        return genai.Client(api_key=os.environ.get("GEMINI_API_KEY"), http_options=http_options)
+
+    @staticmethod
+    def _create_pinecone():
+        from pinecone import Pinecone
+        
+        kwargs = {'api_key': os.environ.get("PINECONE_API_KEY"), 'timeout': SERVICE_TIMEOUT_SECONDS}
+        if os.environ.get("PINECONE_HOST"):
+            kwargs['host'] = os.environ["PINECONE_HOST"]
+        return Pinecone(**kwargs)
+
+    @staticmethod
+    def _create_cohere():
+        import cohere
+        
+        kwargs = {'api_key': os.environ.get("COHERE_API_KEY"), 'timeout': SERVICE_TIMEOUT_SECONDS}
+        if os.environ.get("COHERE_BASE_URL"):
+            kwargs['base_url'] = os.environ["COHERE_BASE_URL"]
+        return cohere.ClientV2(**kwargs)
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = self._factories[name]()
+            return self._clients[name]
+
+    def gemini(self):
+        return self.get('gemini')
+
+    def pinecone(self):
+        return self.get('pinecone')
+
+    def cohere(self):
+        return self.get('cohere')
+
+    def register(self, name, client=None, factory=None):
+        """Testlerde gerçek istemci yerine yerel bir sahte istemci veya fabrika kullanmak için"""
+        with self._lock:
+            if factory is not None:
+                self._factories[name] = factory
+            self._clients.pop(name, None)
+            if client is not None:
+                self._clients[name] = client
+
+    def reset(self):
+        with self._lock:
+            self._clients.clear()
+
+services = ServiceClients()
+
+def error_status_code(error):
+    for attr in ('code', 'status_code', 'status'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+def is_retryable_error(error):
+    """Hız sınırı, geçici sunucu hataları ve zaman aşımları tekrar denenir"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = error_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    name = type(error).__name__.lower()
+    return any(word in name for word in ('timeout', 'toomanyrequests', 'ratelimit', 'unavailable', 'connect'))
+
+def retry_delay(attempt):
+    # "Full jitter": aynı anda hata alan istekler aynı anda tekrar denemesin
+    delay = min(SERVICE_RETRY_MAX_SECONDS, SERVICE_RETRY_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, delay)
+
+def call_with_retry(fn, *args, **kwargs):
+    """Tekrar denenebilir hatalarda titreşimli (jitter) üstel bekleme ile çağrıyı yineler"""
+    for attempt in range(SERVICE_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= SERVICE_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            time.sleep(retry_delay(attempt))
+
+def stream_with_retry(fn, *args, **kwargs):
+    """Akışı ilk parça gelene kadar tekrar dener; sonrasındaki hatalar çağırana iletilir"""
+    for attempt in range(SERVICE_MAX_RETRIES + 1):
+        try:
+            stream = iter(fn(*args, **kwargs))
+            first = next(stream, None)
+            break
+        except Exception as e:
+            if attempt >= SERVICE_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            time.sleep(retry_delay(attempt))
+    
+    if first is None:
+        return
+    yield first
+    yield from stream
+
+async def call_with_retry_async(fn, *args, **kwargs):
+    for attempt in range(SERVICE_MAX_RETRIES + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= SERVICE_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+
+async def stream_with_retry_async(fn, *args, **kwargs):
+    """stream_with_retry'ın asyncio karşılığı"""
+    for attempt in range(SERVICE_MAX_RETRIES + 1):
+        try:
+            stream = (await fn(*args, **kwargs)).__aiter__()
+            first = await anext(stream, None)
+            break
+        except Exception as e:
+            if attempt >= SERVICE_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+    
+    if first is None:
+        return
+    yield first
+    async for chunk in stream:
+        yield chunk
+
+def run_sync(coro):
+    """Eşzamansız bir işi senkron çağıranlar için çalıştırır; açık bir olay döngüsü varsa ayrı iş parçacığı kullanır"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def iterate_async_generator(agen_factory):
+    """Eşzamansız bir üreteci ayrı bir olay döngüsünde çalıştırıp senkron üreteç olarak sunar"""
+    items = queue.Queue()
+    done = object()
+    
+    async def consume():
+        try:
+            async for item in agen_factory():
+                items.put(('item', item))
+        except BaseException as e:
+            items.put(('error', e))
+        finally:
+            items.put(('done', done))
+    
+    threading.Thread(target=asyncio.run, args=(consume(),), daemon=True).start()
+    while True:
+        kind, value = items.get()
+        if kind == 'item':
+            yield value
+        elif kind == 'error':
+            raise value
+        else:
+            return
+
+EMBEDDING_MODEL = "gemini-embedding-001"
+EMBEDDING_DIMENSION = 768
+EMBEDDING_BATCH_SIZE = 100
+UPSERT_BATCH_SIZE = 100
+LAB_REFERENCE_DIR = "kan_tahlili"
+LAB_INDEX_NAME = "kan-tahlili-reference"
+REFERENCE_CHUNKING = "sections-v1"
+REFERENCE_MANIFEST_FILE = os.environ.get("REFERENCE_MANIFEST_FILE", os.path.join("cache", "reference_manifest.json"))
+
+EMBEDDING_CACHE_FILE = os.environ.get("EMBEDDING_CACHE_FILE", os.path.join("cache", "embeddings.sqlite"))
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", "64")) * 1024 * 1024
+
+class EmbeddingCache:
+    """Gömme vektörlerini float32 olarak diskte saklayan, boyut sınırlı yerel önbellek"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        return self._conn
+
+    @staticmethod
+    def key(model, dimension, text):
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{model}:{dimension}:{text_hash}"
+
+    def get_many(self, keys):
+        """Bulunan anahtarlar için {anahtar: vektör} döndürür"""
+        if not keys:
+            return {}
+        
+        with self._lock:
+            conn = self._connection()
+            found = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+            
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+                conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+            record_cache_lookup('embedding', hits=len(found), misses=len(set(keys)) - len(found))
+            return found
+
+    def put_many(self, items):
+        if not items:
+            return
+        
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items]
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        # En uzun süre kullanılmayan kayıtları sınırın %90'ına inene kadar sil
+        target = int(self.max_bytes * 0.9)
+        rows = conn.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= target:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM embeddings WHERE key = ?", stale)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES)
+
+def get_gemini_embeddings(texts):
+    """Metin listesini toplu olarak gömer; başarısız olursa None döndürür"""
+    if not texts:
+        return []
+    
+    try:
+        keys = [EmbeddingCache.key(EMBEDDING_MODEL, EMBEDDING_DIMENSION, text) for text in texts]
+        try:
+            cached = embedding_cache.get_many(keys)
+        except sqlite3.Error as e:
+            print(f"Embedding önbelleği okunamadı: {e}")
+            cached = {}
+        
+        # Aynı metin listede birden fazla geçse de yalnızca bir kez gömülür
+        missing = list(dict.fromkeys(
+            (key, text) for key, text in zip(keys, texts) if key not in cached
+        ))
+        
+        if missing:
+            client = services.gemini()
+            
+            fresh = []
+            for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+                batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+                with span('embedding', texts=len(batch)):
+                    result = call_with_retry(
+                        client.models.embed_content,
+                        model=EMBEDDING_MODEL,
+                        contents=[text for _, text in batch],
+                        config=types.EmbedContentConfig(output_dimensionality=EMBEDDING_DIMENSION)
+                    )
+                fresh.extend(
+                    (key, embedding_obj.values)
+                    for (key, _), embedding_obj in zip(batch, result.embeddings)
+                )
+            
+            try:
+                embedding_cache.put_many(fresh)
+            except sqlite3.Error as e:
+                print(f"Embedding önbelleğine yazılamadı: {e}")
+            cached.update((key, np.asarray(values, dtype=np.float32)) for key, values in fresh)
         
-        [embedding_obj] = result.embeddings
-        return embedding_obj.values
+        return [cached[key].tolist() for key in keys]
         
     except Exception as e:
         print(f"Gemini embedding oluşturma hatası: {e}")
         return None
 
+def get_gemini_embedding(text):
+    embeddings = get_gemini_embeddings([text])
+    if not embeddings:
+        return None
+    return embeddings[0]
+
+def reference_vector_id(lab_name):
+    ascii_id = lab_name.encode('ascii', 'ignore').decode('ascii')
+    if not ascii_id:
+        # hash() süreçler arasında değiştiği için sabit bir özet kullan
+        ascii_id = f"lab_{hashlib.sha1(lab_name.encode('utf-8')).hexdigest()[:10]}"
+    return ascii_id
+
+def read_lab_reference_files():
+    lab_data = {}
+    for filename in sorted(os.listdir(LAB_REFERENCE_DIR)):
+        if filename.endswith('.txt'):
+            lab_name = filename.replace('.txt', '')
+            with open(os.path.join(LAB_REFERENCE_DIR, filename), 'r', encoding='utf-8') as f:
+                lab_data[lab_name] = f.read()
+    return lab_data
+
+def reference_manifest_header():
+    # Bunlardan biri değişirse indeksteki vektörler geçersiz sayılır
+    return {
+        'backend': RETRIEVAL_BACKEND,
+        'index': LAB_INDEX_NAME,
+        'model': EMBEDDING_MODEL,
+        'dimension': EMBEDDING_DIMENSION,
+        'chunking': REFERENCE_CHUNKING,
+    }
+
+def load_reference_manifest():
+    """Daha önce indekslenen dosyaların içerik özetlerini okur; manifest yoksa veya başka ayarlarla yazılmışsa None"""
+    expected = reference_manifest_header()
+    try:
+        with open(REFERENCE_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if any(manifest.get(key) != value for key, value in expected.items()):
+        return None
+    return manifest.get('files', {})
+
+def save_reference_manifest(files):
+    manifest = dict(reference_manifest_header(), files=files)
+    os.makedirs(os.path.dirname(REFERENCE_MANIFEST_FILE) or ".", exist_ok=True)
+    tmp_file = f"{REFERENCE_MANIFEST_FILE}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_file, REFERENCE_MANIFEST_FILE)
+
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "pinecone").lower()
+LOCAL_VECTOR_DIR = os.environ.get("LOCAL_VECTOR_DIR", os.path.join("cache", "vectors"))
+
+class PineconeBackend:
+    """Referans vektörlerini uzak Pinecone indeksinde tutar"""
+
+    name = "pinecone"
+
+    def __init__(self, index_name):
+        self.index_name = index_name
+        self._index = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """İndeksi hazırlar; yeni oluşturulduysa True döndürür"""
+        with self._lock:
+            pc = services.pinecone()
+            created = False
+            if self.index_name not in pc.list_indexes().names():
+                pc.create_index(
+                    name=self.index_name,
+                    dimension=EMBEDDING_DIMENSION,  # Gemini embedding boyutu
+                    metric="cosine"
+                )
+                created = True
+            self._index = pc.Index(self.index_name)
+            return created
+
+    def _get_index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = services.pinecone().Index(self.index_name)
+            return self._index
+
+    def upsert(self, vectors):
+        call_with_retry(self._get_index().upsert, vectors=vectors, timeout=SERVICE_TIMEOUT_SECONDS)
+
+    def delete(self, ids):
+        call_with_retry(self._get_index().delete, ids=ids, timeout=SERVICE_TIMEOUT_SECONDS)
+
+    def clear(self):
+        try:
+            call_with_retry(self._get_index().delete, delete_all=True, timeout=SERVICE_TIMEOUT_SECONDS)
+        except Exception as e:
+            # Boş indekste ad alanı bulunamadı hatası döner
+            if error_status_code(e) != 404:
+                raise
+
+    def query(self, vector, top_k):
+        search_results = call_with_retry(
+            self._get_index().query,
+            vector=vector,
+            top_k=top_k,
+            include_metadata=True,
+            timeout=SERVICE_TIMEOUT_SECONDS
+        )
+        return [
+            {'id': match['id'], 'score': match['score'], 'metadata': match['metadata']}
+            for match in search_results['matches']
+        ]
+
+class LocalVectorBackend:
+    """Normalize edilmiş vektörleri diskteki bir NumPy matrisinden bellek eşlemeli okur ve tam kosinüs araması yapar"""
+
+    name = "local"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.matrix_file = os.path.join(directory, "vectors.npy")
+        self.entries_file = os.path.join(directory, "entries.json")
+        self._matrix = np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32)
+        self._entries = []
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if os.path.exists(self.matrix_file) and os.path.exists(self.entries_file):
+            with open(self.entries_file, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+            self._matrix = np.load(self.matrix_file, mmap_mode='r')
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._load()
+
+    def open(self):
+        with self._lock:
+            created = not os.path.exists(self.matrix_file)
+            self._load()
+            return created
+
+    def _save(self, matrix, entries):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_matrix = os.path.join(self.directory, "vectors.tmp.npy")
+        tmp_entries = f"{self.entries_file}.tmp"
+        np.save(tmp_matrix, matrix)
+        with open(tmp_entries, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_matrix, self.matrix_file)
+        os.replace(tmp_entries, self.entries_file)
+        self._entries = entries
+        self._matrix = np.load(self.matrix_file, mmap_mode='r')
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def upsert(self, vectors):
+        with self._lock:
+            self._ensure_loaded()
+            positions = {entry['id']: i for i, entry in enumerate(self._entries)}
+            matrix = np.array(self._matrix, dtype=np.float32)
+            entries = list(self._entries)
+            new_rows = []
+            for vector in vectors:
+                row = self._normalize(vector['values'])
+                entry = {'id': vector['id'], 'metadata': vector['metadata']}
+                if vector['id'] in positions:
+                    matrix[positions[vector['id']]] = row
+                    entries[positions[vector['id']]] = entry
+                else:
+                    positions[vector['id']] = len(entries)
+                    entries.append(entry)
+                    new_rows.append(row)
+            if new_rows:
+                matrix = np.vstack([matrix.reshape(-1, EMBEDDING_DIMENSION), np.stack(new_rows)])
+            self._save(matrix, entries)
+
+    def delete(self, ids):
+        with self._lock:
+            self._ensure_loaded()
+            ids = set(ids)
+            keep = [i for i, entry in enumerate(self._entries) if entry['id'] not in ids]
+            matrix = np.array(self._matrix, dtype=np.float32).reshape(-1, EMBEDDING_DIMENSION)[keep]
+            self._save(matrix, [self._entries[i] for i in keep])
+
+    def clear(self):
+        with self._lock:
+            self._save(np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32), [])
+
+    def query(self, vector, top_k):
+        with self._lock:
+            self._ensure_loaded()
+            matrix, entries = self._matrix, self._entries
+        if not entries:
+            return []
+        
+        scores = matrix @ self._normalize(vector)
+        top_k = min(top_k, len(entries))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {'id': entries[i]['id'], 'score': float(scores[i]), 'metadata': entries[i]['metadata']}
+            for i in top
+        ]
+
+_retrieval_backends = {}
+_retrieval_backends_lock = threading.Lock()
+
+def get_retrieval_backend(name=None):
+    """Yapılandırmadaki arama altyapısını (pinecone veya local) döndürür"""
+    name = (name or RETRIEVAL_BACKEND).lower()
+    with _retrieval_backends_lock:
+        if name not in _retrieval_backends:
+            if name == "pinecone":
+                _retrieval_backends[name] = PineconeBackend(LAB_INDEX_NAME)
+            elif name == "local":
+                _retrieval_backends[name] = LocalVectorBackend(LOCAL_VECTOR_DIR)
+            else:
+                raise ValueError(f"Bilinmeyen arama altyapısı: {name}")
+        return _retrieval_backends[name]
+
+class IndexingStatus:
+    """Arka planda süren referans indekslemesinin aşamasını ve ilerlemesini tutar"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # idle: bu süreçte indeksleme başlatılmadı, mevcut indeks olduğu gibi kullanılır
+        self._state = {
+            'state': 'idle',
+            'stage': None,
+            'done': 0,
+            'total': 0,
+            'error': None,
+            'started_at': None,
+            'finished_at': None,
+        }
+
+    def start(self):
+        with self._lock:
+            self._state.update(state='running', stage='starting', done=0, total=0, error=None,
+                               started_at=time.time(), finished_at=None)
+
+    def stage(self, stage, total=0):
+        with self._lock:
+            self._state.update(stage=stage, done=0, total=total)
+
+    def advance(self, count=1):
+        with self._lock:
+            self._state['done'] += count
+
+    def finish(self, error=None):
+        with self._lock:
+            self._state.update(state='failed' if error else 'ready', stage=None,
+                               error=str(error) if error else None, finished_at=time.time())
+
+    def is_searchable(self):
+        """İndeks hazırlanırken vektör araması yerine yerel referans metinleri kullanılır"""
+        with self._lock:
+            return self._state['state'] != 'running'
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = dict(self._state)
+        if snapshot['started_at']:
+            end = snapshot['finished_at'] or time.time()
+            snapshot['elapsed_s'] = round(end - snapshot['started_at'], 1)
+        return snapshot
+
+reference_index_status = IndexingStatus()
+
+def reference_index_gauges():
+    index = reference_index_status.snapshot()
+    return [
+        ('publica_reference_index_progress', {'field': 'done'}, index['done']),
+        ('publica_reference_index_progress', {'field': 'total'}, index['total']),
+        ('publica_reference_index_progress', {'field': 'ready'}, int(index['state'] in ('ready', 'idle'))),
+    ]
+
+metrics.add_collector(reference_index_gauges)
+
 def load_and_index_lab_reference():
     lab_data = {}
-    lab_dir = "kan_tahlili"
     
-    if not os.path.exists(lab_dir):
+    if not os.path.exists(LAB_REFERENCE_DIR):
+        reference_index_status.finish()
         return lab_data
     
+    reference_index_status.start()
+    error = None
     try:
-        pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
-        index_name = "kan-tahlili-reference"
+        reference_index_status.stage('reading')
+        lab_data = read_lab_reference_files()
+        
+        backend = get_retrieval_backend()
+        
+        indexed_files = load_reference_manifest()
+        created = backend.open()
+        if indexed_files is None and not created:
+            # Kimlikleri bilinmeyen eski vektörler (ör. bölümlemeden önceki bütün belge vektörleri) silinmezse
+            # aramada yönsüz bölüm olarak dönmeye devam eder
+            print("Referans manifesti yok veya güncel değil; indeks temizleniyor")
+            backend.clear()
+        if indexed_files is None or created:
+            # Boş indekste her şey yeniden yüklenmeli
+            indexed_files = {}
+        
+        sections = {lab_name: split_reference_sections(content) for lab_name, content in lab_data.items()}
+        current_files = {
+            lab_name: {
+                'sha256': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+                'ids': [
+                    f"{reference_vector_id(lab_name)}-{i}-{section['direction']}-{section['kind']}"
+                    for i, section in enumerate(sections[lab_name])
+                ],
+            }
+            for lab_name, content in lab_data.items()
+        }
+        changed = [
+            lab_name for lab_name, entry in current_files.items()
+            if indexed_files.get(lab_name, {}).get('sha256') != entry['sha256']
+        ]
+        deleted = [lab_name for lab_name in indexed_files if lab_name not in current_files]
         
-        try:
-            index = pc.Index(index_name)
-        except:
-            pc.create_index(
-                name=index_name,
-                dimension=768,  # Gemini embedding boyutu
-                metric="cosine"
-            )
-            index = pc.Index(index_name)
+        print(f"Referans indeksi: {len(changed)} yeni/değişen, {len(deleted)} silinen, "
+              f"{len(current_files) - len(changed)} değişmeyen dosya")
         
-        for filename in os.listdir(lab_dir):
-            if filename.endswith('.txt'):
-                lab_name = filename.replace('.txt', '')
-                file_path = os.path.join(lab_dir, filename)
-                
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    lab_data[lab_name] = content
-                    
-                    # Gemini embedding kullan
-                    embedding = get_gemini_embedding(content)
-                    
-                    if embedding is not None:
-                        ascii_id = lab_name.encode('ascii', 'ignore').decode('ascii')
-                        if not ascii_id:
-                            ascii_id = f"lab_{hash(lab_name) % 10000}"
-                        
-                        index.upsert(vectors=[{
-                            'id': ascii_id,
-                            'values': embedding,
-                            'metadata': {
-                                'lab_name': lab_name,
-                                'content': content
-                            }
-                        }])
+        chunks = [
+            (lab_name, vector_id, section)
+            for lab_name in changed
+            for vector_id, section in zip(current_files[lab_name]['ids'], sections[lab_name])
+        ]
+        reference_index_status.stage('embedding', total=len(chunks))
+        embeddings = get_gemini_embeddings([f"{lab_name}\n{section['text']}" for lab_name, _, section in chunks])
+        if embeddings is None:
+            # Gömme başarısızsa eski vektörler silinmeden indeks başarısız olarak işaretlenir
+            raise RuntimeError("Referans bölümleri için embedding oluşturulamadı")
+        
+        stale_ids = [vector_id for lab_name in deleted for vector_id in indexed_files[lab_name]['ids']]
+        # Değişen dosyalardan artık bulunmayan bölümlerin vektörlerini de temizle
+        for lab_name in changed:
+            if lab_name in indexed_files:
+                current_ids = set(current_files[lab_name]['ids'])
+                stale_ids += [i for i in indexed_files[lab_name]['ids'] if i not in current_ids]
+        for start in range(0, len(stale_ids), UPSERT_BATCH_SIZE):
+            backend.delete(stale_ids[start:start + UPSERT_BATCH_SIZE])
+        for lab_name in deleted:
+            del indexed_files[lab_name]
+        
+        vectors = [
+            {
+                'id': vector_id,
+                'values': embedding,
+                'metadata': {
+                    'lab_name': lab_name,
+                    'direction': section['direction'],
+                    'section': section['kind'],
+                    'content': section['text']
+                }
+            }
+            for (lab_name, vector_id, section), embedding in zip(chunks, embeddings)
+        ]
+        # Bir dosyanın tüm bölümleri yüklenmeden manifeste yazılmaz
+        remaining = {lab_name: len(current_files[lab_name]['ids']) for lab_name in changed}
+        reference_index_status.stage('upserting', total=len(vectors))
+        for start in range(0, len(vectors), UPSERT_BATCH_SIZE):
+            batch = vectors[start:start + UPSERT_BATCH_SIZE]
+            backend.upsert(batch)
+            reference_index_status.advance(len(batch))
+            for vector in batch:
+                lab_name = vector['metadata']['lab_name']
+                remaining[lab_name] -= 1
+                if remaining[lab_name] == 0:
+                    indexed_files[lab_name] = current_files[lab_name]
+            # Yarıda kesilirse tamamlanan partiler tekrar gömülmesin
+            save_reference_manifest(indexed_files)
+        
+        save_reference_manifest(indexed_files)
                     
     except Exception as e:
         print(f"Kan tahlili verileri yüklenirken hata: {e}")
+        error = e
     
+    reference_index_status.finish(error)
     return lab_data
 
-def detect_abnormal_values(df):
-    abnormal_values = []
+TURKISH_FOLD = str.maketrans({
+    'İ': 'i', 'I': 'i', 'ı': 'i',
+    'Ş': 's', 'ş': 's', 'Ğ': 'g', 'ğ': 'g',
+    'Ü': 'u', 'ü': 'u', 'Ö': 'o', 'ö': 'o',
+    'Ç': 'c', 'ç': 'c', 'Â': 'a', 'â': 'a',
+})
+
+# Aynı testin raporlarda ve referans dosyalarında geçen farklı adları
+TEST_NAME_ALIASES = [
+    ["Glike hemoglobin (HbA1c)", "HBA1C (%)", "HbA1C (mmol mol)", "HbA1c", "A1c"],
+    ["Glukoz (Açlık Kan Şekeri)", "Glukoz", "Açlık kan şekeri", "AKŞ", "Açlık glukozu"],
+    ["Gulukoz-idrar", "Gulukoz", "İdrar glukozu", "Glukoz (idrar)"],
+    ["Toplam lökosit sayısı(WBC)", "Lökosit sayısı", "Beyaz küre"],
+    ["Lökosit", "Lokosit", "İdrar lökositi"],
+    ["C reaktif protein (CRP)", "CRP, türbidimetrik", "CRP"],
+    ["Amilaz", "Amilaz (Serum Plazma)"],
+    ["Bazofil Yüzdesi (BA%)", "BASO", "BASO%"],
+    ["Eozinofil Yüzdesi(EO%)", "EOS%", "EOS"],
+    ["Lenfosit Yüzdesi (LY%)", "LYM%", "LYM"],
+    ["Ortalama eritrosit Hemoglobin (MCH)", "Ortalama eritrosit hgb(MCH)"],
+    ["Eritrosit dağ. gen.(RDW%)", "RDW", "RDW-CV"],
+    ["Sedimentasyon", "ESR", "Eritrosit sedimentasyon hızı"],
+    ["Bilirübin", "İdrar bilirubini"],
+    ["Bilirubin (total)", "Total bilirubin", "T. Bilirubin"],
+    ["Bilirubin (direkt)", "Direkt bilirubin", "D. Bilirubin"],
+    ["Üre (Serum Plazma)", "Üre", "BUN"],
+    ["Klorür (Serum Plazma)", "Klorür", "Klor"],
+    ["Total testesteron", "Total testosteron", "Testosteron"],
+    ["PSA total (Prostat spesifik antijen)", "Total PSA", "PSA"],
+    ["Demir (serum)", "Demir", "Serum demiri"],
+    ["Demir bağlama kapasitesi (TDBK)", "Total demir bağlama kapasitesi", "TIBC"],
+]
+
+SECTION_HIGH_WORDS = ('yuksek', 'pozitif', 'varligi', 'artis', 'artmis', 'fazla')
+SECTION_LOW_WORDS = ('dusuk', 'negatif', 'yoklugu', 'azalma', 'azalmis', 'eksik', 'az olmasi', 'olmamasi')
+SECTION_KIND_WORDS = {
+    'causes': ('nedenler', 'nedenleri'),
+    'treatment': ('duzeltilir', 'yapilmali', 'oneriler', 'tedavi'),
+}
+SECTION_TITLES = {'high': 'Yüksekliği', 'low': 'Düşüklüğü'}
+
+def classify_reference_heading(line):
+    """Başlık satırı ise ('direction', yön) veya ('kind', tür) döndürür, değilse None"""
+    if not line or len(line) > 100 or line.endswith('.') or line[0] in '•-*':
+        return None
     
-    for index, row in df.iterrows():
-        for col in df.columns:
-            value = str(row[col]).strip()
-            if value and value != 'nan':
-                try:
-                    numeric_value = float(value)
-                    abnormal_values.append({
-                        'test_name': col,
-                        'value': numeric_value,
-                        'row': index
-                    })
-                except:
-                    if any(keyword in value.lower() for keyword in ['yüksek', 'düşük', 'artmış', 'azalmış', 'pozitif', 'negatif']):
-                        abnormal_values.append({
-                            'test_name': col,
-                            'value': value,
-                            'row': index
-                        })
+    folded = line.translate(TURKISH_FOLD).lower()
+    for kind, words in SECTION_KIND_WORDS.items():
+        if any(word in folded for word in words) and len(folded.split()) <= 4:
+            return ('kind', kind)
+    
+    is_question = line.endswith('?') or 'ne anlama gelir' in folded
+    if not is_question and len(folded.split()) > 6:
+        return None
+    if any(word in folded for word in SECTION_HIGH_WORDS):
+        return ('direction', 'high')
+    if any(word in folded for word in SECTION_LOW_WORDS):
+        return ('direction', 'low')
+    if is_question:
+        return ('direction', 'general')
+    return None
+
+def split_reference_sections(content):
+    """Referans metnini yön (high/low/general) ve tür (overview/causes/treatment) etiketli bölümlere ayırır"""
+    sections = []
+    direction, kind = 'general', 'overview'
+    buffer = []
+    
+    def flush():
+        text = "\n".join(buffer).strip()
+        if text:
+            sections.append({'direction': direction, 'kind': kind, 'text': text})
+    
+    for raw_line in content.replace('\ufeff', '').splitlines():
+        line = raw_line.strip()
+        heading = classify_reference_heading(line)
+        if heading is None:
+            buffer.append(raw_line)
+            continue
+        
+        flush()
+        buffer = [line]
+        if heading[0] == 'direction':
+            direction, kind = heading[1], 'overview'
+        else:
+            kind = heading[1]
+    flush()
+    
+    # Tek satırlık başlık bölümleri (ör. sadece "Ferritin") ayrı vektör olmayı hak etmez
+    return [
+        section for section in sections
+        if len(section['text'].splitlines()) > 1 or len(sections) == 1
+    ]
+
+def select_reference_sections(lab_name, sections, direction):
+    """Değerin yönüne uyan bölümleri birleştirir; yönlü bölüm yoksa tüm metni kullanır"""
+    selected = [section for section in sections if section['direction'] == direction]
+    if not selected:
+        selected = sections
+    
+    title = f"### {lab_name}"
+    if direction in SECTION_TITLES:
+        title += f" {SECTION_TITLES[direction]}"
+    return title + "\n" + "\n\n".join(section['text'] for section in selected)
+
+def normalize_test_name(name):
+    """Türkçe harfleri katlayıp noktalama işaretlerini atarak test adını eşleştirmeye hazırlar"""
+    name = str(name).replace('\ufeff', '').translate(TURKISH_FOLD).lower()
+    name = re.sub(r'[^a-z0-9%#]+', ' ', name)
+    return ' '.join(name.split())
+
+def test_name_keys(name):
+    """Tam ad, parantezsiz ad ve parantez içindeki kısaltma anahtarlarını döndürür"""
+    full = normalize_test_name(name)
+    base = normalize_test_name(re.sub(r'\([^)]*\)?', ' ', str(name)))
+    abbreviations = [
+        normalize_test_name(abbr) for abbr in re.findall(r'\(([^)]*)\)?', str(name))
+    ]
+    # Birim veya açıklama değil, tek kelimelik kısaltmaları kullan (HGB, NE%, MCHC)
+    abbreviations = [
+        abbr for abbr in abbreviations
+        if abbr and ' ' not in abbr and re.search(r'[a-z]', abbr)
+    ]
+    return full, base, abbreviations
+
+class ReferenceLookup:
+    """Test adlarını ve takma adlarını referans dosyalarına eşleyen önceden hesaplanmış indeks"""
+
+    def __init__(self, lab_names, aliases=TEST_NAME_ALIASES):
+        self.full = {}
+        self.base = {}
+        self.abbreviation = {}
+        
+        groups = {}
+        for group in aliases:
+            targets = [name for name in group if name in lab_names]
+            for name in group:
+                groups.setdefault(normalize_test_name(name), set()).update(targets)
+        self.aliases = {key: sorted(names) for key, names in groups.items() if names}
+        
+        for lab_name in lab_names:
+            full, base, abbreviations = test_name_keys(lab_name)
+            self.full.setdefault(full, []).append(lab_name)
+            if base:
+                self.base.setdefault(base, []).append(lab_name)
+            for abbr in abbreviations:
+                self.abbreviation.setdefault(abbr, []).append(lab_name)
+
+    def find(self, test_name):
+        """Eşleşen referans dosya adlarını döndürür; bulunamazsa boş liste"""
+        full, base, abbreviations = test_name_keys(test_name)
+        if not full:
+            return []
+        
+        if full in self.full:
+            matches = list(self.full[full])
+            for alias in self.aliases.get(full, []):
+                if alias not in matches:
+                    matches.append(alias)
+            return matches
+        if full in self.aliases:
+            return list(self.aliases[full])
+        if base in self.full:
+            return list(self.full[base])
+        if base in self.aliases:
+            return list(self.aliases[base])
+        for abbr in abbreviations:
+            if abbr in self.abbreviation:
+                return list(self.abbreviation[abbr])
+            if abbr in self.full:
+                return list(self.full[abbr])
+        # Raporda yalnızca kısaltma yazıyorsa (ör. "HGB") ad, dosyalardaki kısaltmalarla karşılaştırılır
+        for key in (full, base):
+            if key in self.abbreviation:
+                return list(self.abbreviation[key])
+        if base in self.base and len(self.base[base]) == 1:
+            return list(self.base[base])
+        return []
+
+_lab_reference_texts = None
+_lab_reference_sections = None
+_reference_lookup = None
+_reference_lookup_lock = threading.Lock()
+
+def get_reference_lookup():
+    """Referans metinlerini ve ad indeksini ilk kullanımda bir kez yükler"""
+    global _lab_reference_texts, _lab_reference_sections, _reference_lookup
+    with _reference_lookup_lock:
+        if _reference_lookup is None:
+            _lab_reference_texts = read_lab_reference_files() if os.path.exists(LAB_REFERENCE_DIR) else {}
+            _lab_reference_sections = {
+                lab_name: split_reference_sections(content)
+                for lab_name, content in _lab_reference_texts.items()
+            }
+            _reference_lookup = ReferenceLookup(set(_lab_reference_texts))
+        return _reference_lookup, _lab_reference_sections
+
+# Türkçe eklemeli olduğu için kelimelerin ilk 5 harfi kök yerine kullanılır (yüksekliği, yüksek -> yukse)
+STEM_LENGTH = 5
+STOP_WORDS = {
+    've', 'ile', 'bir', 'bu', 'da', 'de', 'icin', 'veya', 'olan', 'gibi', 'ne', 'mi', 'cok',
+    'daha', 'en', 'ya', 'olarak', 'ise', 'her', 'ki', 'o', 'su', 'nedir', 'anlama', 'gelir',
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def stem_tokens(text):
+    """Türkçe harfleri katlayıp kelimeleri sabit uzunluklu köklere indirir"""
+    words = re.findall(r'[a-z0-9]+', str(text).translate(TURKISH_FOLD).lower())
+    # Yalın sayılar (sonuç değerleri, madde numaraları) bölümler arasında rastgele eşleşir
+    return [word[:STEM_LENGTH] for word in words if word not in STOP_WORDS and not word.isdigit()]
+
+class LexicalIndex:
+    """Referans bölümleri üzerinde ağırlıkları önceden hesaplanmış BM25 ters indeksi"""
+
+    def __init__(self, documents, k1=BM25_K1, b=BM25_B):
+        self.documents = documents
+        self.positions = {(doc['lab_name'], doc['content']): i for i, doc in enumerate(documents)}
+        term_counts = [Counter(stem_tokens(f"{doc['lab_name']}\n{doc['content']}")) for doc in documents]
+        lengths = [sum(counts.values()) for counts in term_counts]
+        avg_length = sum(lengths) / len(lengths) if lengths else 1.0
+        
+        document_frequency = Counter(term for counts in term_counts for term in counts)
+        total = len(documents)
+        self.postings = {}
+        for i, counts in enumerate(term_counts):
+            norm = k1 * (1 - b + b * lengths[i] / avg_length)
+            for term, tf in counts.items():
+                freq = document_frequency[term]
+                idf = math.log(1 + (total - freq + 0.5) / (freq + 0.5))
+                self.postings.setdefault(term, []).append((i, idf * tf * (k1 + 1) / (tf + norm)))
+
+    def scores(self, query):
+        """Sorguyla en az bir kökü paylaşan bölümlerin BM25 puanları (konum -> puan)"""
+        totals = {}
+        for term in set(stem_tokens(query)):
+            for i, weight in self.postings.get(term, ()):
+                totals[i] = totals.get(i, 0.0) + weight
+        return totals
+
+_lexical_index = None
+_lexical_index_lock = threading.Lock()
+
+def get_lexical_index():
+    """Sözcük indeksini referans bölümlerinden ilk kullanımda bir kez kurar"""
+    global _lexical_index
+    _, lab_sections = get_reference_lookup()
+    with _lexical_index_lock:
+        if _lexical_index is None:
+            _lexical_index = LexicalIndex([
+                {
+                    'lab_name': lab_name,
+                    'direction': section['direction'],
+                    'section': section['kind'],
+                    'content': section['text'],
+                }
+                for lab_name, sections in sorted(lab_sections.items())
+                for section in sections
+            ])
+        return _lexical_index
+
+NUMBER_PATTERN = r'(-?\d+(?:[.,]\d+)?)'
+RESULT_PATTERN = rf'^([<>]=?|[≤≥])?\s*{NUMBER_PATTERN}$'
+RANGE_PATTERN = rf'^{NUMBER_PATTERN}\s*[-–]\s*{NUMBER_PATTERN}$'
+UPPER_BOUND_PATTERN = rf'^(?:<=?|≤)\s*{NUMBER_PATTERN}$'
+LOWER_BOUND_PATTERN = rf'^(?:>=?|≥)\s*{NUMBER_PATTERN}$'
+STATUS_LABELS = {'high': 'Yüksek', 'low': 'Düşük'}
+
+def to_number(series):
+    """Ondalık virgülleri noktaya çevirip sayıya dönüştürür; sayı olmayanlar NaN olur"""
+    return pd.to_numeric(series.str.replace(',', '.', regex=False), errors='coerce').astype(float)
+
+def flag_lab_values(df):
+    """Sonuç ve referans aralıklarını toplu olarak ayrıştırıp her satırı high/low/normal olarak işaretler"""
+    roles = lab_column_roles(df)
+    if df.empty or 'test' not in roles or 'result' not in roles:
+        return pd.DataFrame()
+    
+    def text_column(role):
+        if role not in roles:
+            return pd.Series(pd.NA, index=df.index, dtype='string')
+        return df[roles[role]].astype('string').str.strip().replace('', pd.NA)
+    
+    test = text_column('test')
+    result = text_column('result')
+    unit = text_column('unit')
+    reference = text_column('reference')
+    # Aynı tarihteki alt satırlarda tarih "-" olarak geçer
+    date = text_column('date').replace('-', pd.NA).ffill()
+    
+    value_parts = result.str.extract(RESULT_PATTERN)
+    bound = value_parts[0].fillna('')
+    value = to_number(value_parts[1])
+    
+    range_parts = reference.str.extract(RANGE_PATTERN)
+    low = to_number(range_parts[0]).fillna(to_number(reference.str.extract(LOWER_BOUND_PATTERN)[0]))
+    high = to_number(range_parts[1]).fillna(to_number(reference.str.extract(UPPER_BOUND_PATTERN)[0]))
+    
+    below = bound.str.startswith('<') | (bound == '≤')
+    above = bound.str.startswith('>') | (bound == '≥')
+    is_high = ((value > high) & ~below) | (above & (value >= high))
+    is_low = ((value < low) & ~above) | (below & (value <= low))
+    
+    # Sayısal olmayan sonuçlarda yalnızca açık anlamlı ifadeler işaretlenir
+    qualitative = value.isna() & result.notna()
+    folded = result.fillna('').str.translate(TURKISH_FOLD).str.lower()
+    qualitative_high = qualitative & folded.str.contains('pozitif|yuksek|artmis', regex=True)
+    qualitative_low = qualitative & folded.str.contains('dusuk|azalmis', regex=True)
+    
+    is_high = (is_high | qualitative_high).to_numpy(dtype=bool)
+    is_low = (is_low | qualitative_low).to_numpy(dtype=bool)
+    has_range = (value.notna() & (low.notna() | high.notna())).to_numpy(dtype=bool)
+    flag = np.select([is_high, is_low, has_range], ['high', 'low', 'normal'], default='')
+    
+    return pd.DataFrame({
+        'test': test,
+        'result': result,
+        'value': value,
+        'unit': unit,
+        'reference': reference,
+        'low': low,
+        'high': high,
+        'date': date,
+        'flag': pd.Series(flag, index=df.index).replace('', pd.NA),
+    }, index=df.index)
+
+def detect_abnormal_values(df, flags=None):
+    flags = flag_lab_values(df) if flags is None else flags
+    if flags.empty:
+        return []
+    
+    abnormal = flags[flags['flag'].isin(['high', 'low'])]
+    
+    abnormal_values = []
+    for row_index, row in zip(abnormal.index, abnormal.itertuples(index=False)):
+        abnormal_values.append({
+            'test_name': row.test,
+            'value': row.value if not pd.isna(row.value) else row.result,
+            'unit': row.unit if not pd.isna(row.unit) else "",
+            'reference': row.reference if not pd.isna(row.reference) else "",
+            'date': row.date if not pd.isna(row.date) else "",
+            'direction': row.flag,
+            'status': STATUS_LABELS[row.flag],
+            'row': row_index
+        })
     
     return abnormal_values
 
-def get_relevant_references(abnormal_values):
-    if not abnormal_values:
+RESULTS_STORE_FILE = os.environ.get("RESULTS_STORE_FILE", os.path.join("data", "results.sqlite"))
+HISTORY_MAX_POINTS = int(os.environ.get("HISTORY_MAX_POINTS", "6"))
+REPORT_DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y', '%Y-%m-%d')
+
+def parse_report_date(text):
+    """e-Nabız tarih hücresini ISO tarihe (YYYY-MM-DD) çevirir; tanınmazsa None"""
+    if text is None or pd.isna(text):
+        return None
+    text = " ".join(str(text).split())
+    for date_format in REPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def result_test_key(test_name):
+    """Farklı laboratuvarların yazımlarını birleştirmek için referans dosya adını, yoksa normalize adı kullanır"""
+    lookup, _ = get_reference_lookup()
+    matches = lookup.find(test_name)
+    return normalize_test_name(matches[0] if matches else test_name)
+
+def optional_float(value):
+    return None if pd.isna(value) else float(value)
+
+def optional_text(value):
+    return None if pd.isna(value) else str(value)
+
+RESULTS_SCHEMA_VERSION = 2
+
+def require_patient(patient_id):
+    """Geçmiş yalnızca açıkça verilen hasta kimliğine göre tutulur; kimliksiz sonuçlar başka hastalara karışır"""
+    if not patient_id:
+        raise ValueError("Sonuç geçmişi için hasta kimliği gerekli")
+    return str(patient_id)
+
+class ResultsStore:
+    """Çıkarılan sonuçları hasta, rapor özeti, test ve tarihe göre indeksleyen, yalnızca ekleme yapılan SQLite deposu"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                self._migrate_unscoped()
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reports ("
+                "patient TEXT NOT NULL, sha256 TEXT NOT NULL, file_name TEXT, rows INTEGER NOT NULL, "
+                "ingested_at REAL NOT NULL, PRIMARY KEY (patient, sha256))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "patient TEXT NOT NULL, report_sha256 TEXT NOT NULL, row_index INTEGER NOT NULL, "
+                "test TEXT NOT NULL, test_key TEXT NOT NULL, measured_on TEXT, "
+                "result TEXT, value REAL, unit TEXT, reference TEXT, low REAL, high REAL, flag TEXT, "
+                "PRIMARY KEY (patient, report_sha256, row_index))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_patient_test_date ON results(patient, test_key, measured_on)"
+            )
+            if version == 0:
+                self._conn.execute(f"PRAGMA user_version = {RESULTS_SCHEMA_VERSION}")
+        return self._conn
+
+    def _migrate_unscoped(self):
+        """Hasta kimliği olmadan yazılmış ilk sürüm tablolarını silmeden ayrı tablolara taşır"""
+        for table in ('reports', 'results'):
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if columns and 'patient' not in columns:
+                # Bu satırlar hiçbir hastaya güvenle bağlanamaz; geçmişe katılmaz ama korunur
+                with self._conn:
+                    self._conn.execute(f"ALTER TABLE {table} RENAME TO {table}_unscoped")
+
+    def has_report(self, patient_id, report_hash):
+        patient_id = require_patient(patient_id)
+        with self._lock:
+            return self._connection().execute(
+                "SELECT 1 FROM reports WHERE patient = ? AND sha256 = ?", (patient_id, report_hash)
+            ).fetchone() is not None
+
+    def ingest(self, patient_id, report_hash, df, file_name=None):
+        """Raporu hastanın geçmişine bir kez ekler; aynı rapor tekrar geldiğinde hiçbir şey yazmaz. Eklenen satır sayısını döndürür"""
+        patient_id = require_patient(patient_id)
+        if self.has_report(patient_id, report_hash):
+            return 0
+        
+        flagged = flag_lab_values(df)
+        if flagged.empty:
+            return 0
+        
+        rows = [
+            (
+                patient_id, report_hash, row_index, str(row.test), result_test_key(row.test), parse_report_date(row.date),
+                optional_text(row.result), optional_float(row.value), optional_text(row.unit),
+                optional_text(row.reference), optional_float(row.low), optional_float(row.high),
+                optional_text(row.flag),
+            )
+            for row_index, row in enumerate(flagged.itertuples(index=False))
+            if not pd.isna(row.test)
+        ]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO reports (patient, sha256, file_name, rows, ingested_at) VALUES (?, ?, ?, ?, ?)",
+                    (patient_id, report_hash, file_name, len(rows), time.time())
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO results (patient, report_sha256, row_index, test, test_key, measured_on, "
+                    "result, value, unit, reference, low, high, flag) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        return len(rows)
+
+    def history(self, patient_id, test_names, limit=None):
+        """Hastanın her testi için tarih sırasıyla son `limit` ölçümü {test_key: [satırlar]} olarak döndürür"""
+        patient_id = require_patient(patient_id)
+        keys = sorted({result_test_key(name) for name in test_names})
+        if not keys:
+            return {}
+        
+        with self._lock:
+            conn = self._connection()
+            placeholders = ",".join("?" * len(keys))
+            rows = conn.execute(
+                "SELECT test_key, measured_on, test, result, value, unit, reference, flag, report_sha256 "
+                f"FROM results WHERE patient = ? AND test_key IN ({placeholders}) AND measured_on IS NOT NULL "
+                "ORDER BY test_key, measured_on, report_sha256, row_index",
+                [patient_id] + keys
+            ).fetchall()
+        
+        history = {}
+        for test_key, measured_on, test, result, value, unit, reference, flag, report_hash in rows:
+            history.setdefault(test_key, []).append({
+                'date': measured_on, 'test': test, 'result': result, 'value': value,
+                'unit': unit, 'reference': reference, 'flag': flag, 'report': report_hash,
+            })
+        if limit:
+            history = {key: points[-limit:] for key, points in history.items()}
+        return history
+
+    def series(self, patient_id, test_name):
+        """Hastanın tek bir testteki tüm ölçümlerini tarih sırasıyla DataFrame olarak döndürür"""
+        points = self.history(patient_id, [test_name]).get(result_test_key(test_name), [])
+        return pd.DataFrame(points, columns=['date', 'test', 'result', 'value', 'unit', 'reference', 'flag', 'report'])
+
+    def revision(self, patient_id, test_names):
+        """Hastanın verilen testlerine yeni ölçüm eklendiğinde değişen kısa bir özet (analiz önbelleği anahtarı için)"""
+        patient_id = require_patient(patient_id)
+        keys = sorted({result_test_key(name) for name in test_names})
+        if not keys:
+            return ""
+        with self._lock:
+            placeholders = ",".join("?" * len(keys))
+            count, reports = self._connection().execute(
+                "SELECT COUNT(*), COUNT(DISTINCT report_sha256) FROM results "
+                f"WHERE patient = ? AND test_key IN ({placeholders})",
+                [patient_id] + keys
+            ).fetchone()
+        return f"{count}-{reports}"
+
+    def stats(self):
+        with self._lock:
+            conn = self._connection()
+            reports = conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+            results = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {'reports': reports, 'results': results}
+
+results_store = ResultsStore(RESULTS_STORE_FILE)
+
+def ingest_report(patient_id, report_hash, df, file_name=None):
+    try:
+        with span('results_ingest') as info:
+            info['rows'] = results_store.ingest(patient_id, report_hash, df, file_name)
+    except sqlite3.Error as e:
+        print(f"Sonuç deposuna yazılamadı: {e}")
+
+def lab_history_text(abnormal_values, patient_id=None):
+    """Hastanın anormal testlerinin önceki raporlardaki seyrini isteme eklenecek kısa satırlara çevirir"""
+    # Hasta kimliği yoksa (ör. çok kullanıcılı arayüz) geçmiş kullanılmaz
+    if not abnormal_values or not patient_id:
         return ""
     
     try:
-        pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
-        index = pc.Index("kan-tahlili-reference")
-        
-        co = cohere.ClientV2(api_key=os.environ.get("COHERE_API_KEY"))
+        history = results_store.history(patient_id, [item['test_name'] for item in abnormal_values], HISTORY_MAX_POINTS)
+    except sqlite3.Error as e:
+        print(f"Sonuç geçmişi okunamadı: {e}")
+        return ""
+    
+    lines = []
+    seen = set()
+    for item in abnormal_values:
+        key = result_test_key(item['test_name'])
+        points = history.get(key, [])
+        # Tek tarihli ölçüm seyir göstermez
+        if key in seen or len({point['date'] for point in points}) < 2:
+            continue
+        seen.add(key)
+        trend = " → ".join(
+            f"{point['date']}: {point['result']}"
+            + (f" ({STATUS_LABELS[point['flag']]})" if point['flag'] in STATUS_LABELS else "")
+            for point in points
+        )
+        unit = f" ({item['unit']})" if item.get('unit') else ""
+        lines.append(f"- {item['test_name']}{unit}: {trend}")
+    
+    if not lines:
+        return ""
+    return "Önceki raporlardaki sonuçlar (eskiden yeniye):\n" + "\n".join(lines)
+
+# hybrid: vektör ve BM25 puanları süreç içinde birleştirilir; cohere: yerel sıralamanın adayları ayrıca Cohere'a gönderilir
+RERANK_BACKEND = os.environ.get("RERANK_BACKEND", "hybrid").lower()
+HYBRID_VECTOR_WEIGHT = float(os.environ.get("HYBRID_VECTOR_WEIGHT", "0.5"))
+HYBRID_LEXICAL_CANDIDATES = 10
+# En iyi bölümün puanına göre bu oranın altında kalanlar isteme eklenmez
+HYBRID_MIN_SCORE = 0.5
+RERANK_TOP_N = 10
+COHERE_MIN_SCORE = 0.7
+
+def hybrid_rerank(query_text, matches, directions, top_n=RERANK_TOP_N):
+    """Vektör benzerliğini BM25 puanıyla birleştirir; (puan, metadata) listesini azalan sırayla döndürür"""
+    lexical = get_lexical_index()
+    lexical_scores = lexical.scores(query_text)
+    
+    candidates = {}
+    for match in matches:
+        metadata = match['metadata']
+        candidates[(metadata['lab_name'], metadata['content'])] = (match['score'], metadata)
+    # Vektör aramasının kaçırdığı ama kökleri güçlü eşleşen bölümler de aday olur
+    best_lexical = sorted(lexical_scores.items(), key=lambda item: -item[1])[:HYBRID_LEXICAL_CANDIDATES]
+    for i, _ in best_lexical:
+        metadata = lexical.documents[i]
+        if metadata['direction'] in directions:
+            candidates.setdefault((metadata['lab_name'], metadata['content']), (None, metadata))
+    if not candidates:
+        return []
+    
+    vector_scores = [score for score, _ in candidates.values() if score is not None]
+    low, high = (min(vector_scores), max(vector_scores)) if vector_scores else (0.0, 0.0)
+    top_lexical = best_lexical[0][1] if best_lexical else 0.0
+    
+    ranked = []
+    for key, (vector_score, metadata) in candidates.items():
+        if vector_score is None:
+            vector_part = 0.0
+        else:
+            vector_part = (vector_score - low) / (high - low) if high > low else 1.0
+        # İndeks güncellenmeden önce yüklenmiş eski bölümlerin sözcük puanı yoktur
+        position = lexical.positions.get(key)
+        lexical_part = lexical_scores.get(position, 0.0) / top_lexical if top_lexical else 0.0
+        score = HYBRID_VECTOR_WEIGHT * vector_part + (1 - HYBRID_VECTOR_WEIGHT) * lexical_part
+        ranked.append((score, metadata))
+    
+    ranked.sort(key=lambda item: -item[0])
+    best = ranked[0][0]
+    return [(score, metadata) for score, metadata in ranked[:top_n] if score >= best * HYBRID_MIN_SCORE]
+
+def cohere_rerank(query_text, documents):
+    """İsteğe bağlı ikinci aşama; Cohere'a ulaşılamazsa yerel sıralama aynen kullanılır"""
+    try:
+        with span('cohere_rerank', documents=len(documents)) as info:
+            rerank_results = call_with_retry(
+                services.cohere().rerank,
+                model="rerank-v3.5",
+                query=query_text,
+                documents=documents,
+                top_n=len(documents)
+            )
+            kept = [
+                documents[result.index] for result in rerank_results.results
+                if result.relevance_score > COHERE_MIN_SCORE
+            ]
+            info['kept'] = len(kept)
+        return kept
+    except Exception as e:
+        print(f"Cohere sıralama hatası, yerel sıralama kullanılıyor: {e}")
+        return documents
+
+def search_references(abnormal_values):
+    """Doğrudan eşleşmeyen testler için embedding, vektör arama ve yerel hibrit sıralama kullanır; arama yapılamazsa None"""
+    try:
+        backend = get_retrieval_backend()
         
-        query_text = " ".join([f"{item['test_name']} {item['value']}" for item in abnormal_values])
+        query_text = " ".join([
+            f"{item['test_name']} {item['value']} {item.get('status', '')}".strip()
+            for item in abnormal_values
+        ])
         
         # Gemini embedding kullan
         query_embedding = get_gemini_embedding(query_text)
         
         if query_embedding is None:
-            return ""
+            return None
         
-        search_results = index.query(
-            vector=query_embedding,
-            top_k=20,
-            include_metadata=True
-        )
+        with span('vector_search', backend=backend.name) as info:
+            matches = backend.query(query_embedding, top_k=20)
+            info['matches'] = len(matches)
         
-        if search_results['matches']:
-            documents = [match['metadata']['content'] for match in search_results['matches']]
-            rerank_results = co.rerank(
-                model="rerank-v3.5",
-                query=query_text,
-                documents=documents,
-                top_n=10
-            )
-            
-            relevant_refs = []
-            for result in rerank_results.results:
-                if result.relevance_score > 0.7:
-                    relevant_refs.append(documents[result.index])
-            
-            return "\n\n".join(relevant_refs)
+        # Yalnızca işaretli değerlerin yönüne uyan bölümler isteme eklenir
+        directions = {item.get('direction') for item in abnormal_values} | {'general'}
+        matches = [match for match in matches if match['metadata'].get('direction', 'general') in directions]
+        
+        with span('rerank', backend='hybrid', documents=len(matches)) as info:
+            ranked = hybrid_rerank(query_text, matches, directions)
+            info['kept'] = len(ranked)
+        
+        relevant_refs = [f"### {metadata['lab_name']}\n{metadata['content']}" for _, metadata in ranked]
+        if relevant_refs and RERANK_BACKEND == 'cohere':
+            relevant_refs = cohere_rerank(query_text, relevant_refs)
+        
+        metrics.inc('publica_retrieved_documents_total', len(relevant_refs), source='vector')
+        return relevant_refs
         
     except Exception as e:
         print(f"Referans arama hatası: {e}")
     
-    return ""
+    return None
 
-def analyze_with_gemini(df):
-    if df.empty:
-        return "Analiz edilecek veri bulunamadı."
+ANALYSIS_RETRIEVAL_CONCURRENCY = int(os.environ.get("ANALYSIS_RETRIEVAL_CONCURRENCY", "8"))
+
+async def retrieve_test_references_async(item, lookup, lab_sections, semaphore):
+    """Tek bir anormal test için referans bölümlerini bulur; ad eşleşmesi varsa ağ çağrısı yapmaz. Arama yapılamadıysa None"""
+    lab_names = lookup.find(item['test_name'])
+    if lab_names:
+        direction = item.get('direction', 'general')
+        metrics.inc('publica_retrieved_documents_total', len(lab_names), source='lookup')
+        return [select_reference_sections(lab_name, lab_sections[lab_name], direction) for lab_name in lab_names]
     
-    try:
-        markdown_content = df.to_markdown(index=False)
-        
-        abnormal_values = detect_abnormal_values(df)
+    if not reference_index_status.is_searchable():
+        # İndeks hazır olana kadar yalnızca adla eşleşen yerel referans metinleri kullanılır
+        return None
+    
+    async with semaphore:
+        return await asyncio.to_thread(search_references, [item])
+
+async def collect_references_async(abnormal_values, concurrency=None):
+    """Her anormal test için aramayı sınırlı eşzamanlılıkla paralel yürütür.
+    (öncelik sırasıyla bölümler, eksiksiz mi) döndürür; indeks hazır değilse veya arama başarısızsa eksik sayılır"""
+    if not abnormal_values:
+        return [], True
+    
+    with span('retrieval', tests=len(abnormal_values)) as info:
+        lookup, lab_sections = await asyncio.to_thread(get_reference_lookup)
+        semaphore = asyncio.Semaphore(concurrency or ANALYSIS_RETRIEVAL_CONCURRENCY)
         
-        relevant_references = get_relevant_references(abnormal_values)
+        tasks = [
+            asyncio.create_task(retrieve_test_references_async(item, lookup, lab_sections, semaphore))
+            for item in abnormal_values
+        ]
+        results = await asyncio.gather(*tasks)
+        
+        # Sonuçlar testlerin rapordaki sırasıyla ve tekrarsız birleştirilir
+        relevant_refs = []
+        for refs in results:
+            for ref in refs or []:
+                if ref not in relevant_refs:
+                    relevant_refs.append(ref)
+        complete = all(refs is not None for refs in results) and reference_index_status.snapshot()['state'] != 'failed'
+        info.update(documents=len(relevant_refs), complete=complete)
+    
+    return relevant_refs, complete
+
+async def get_relevant_references_async(abnormal_values, concurrency=None):
+    """Yalnızca referans bölümlerini döndürür"""
+    relevant_refs, _ = await collect_references_async(abnormal_values, concurrency)
+    return relevant_refs
+
+def get_relevant_references(abnormal_values):
+    return run_sync(get_relevant_references_async(abnormal_values))
+
+GEMINI_MODEL = "gemini-2.5-flash"
+# İstem şablonu değiştiğinde artırılmalı; eski önbellekli analizler geçersiz olur
+PROMPT_TEMPLATE_VERSION = 5
+# Yerel tahmine göre istem üst sınırı; aşılırsa önce referanslar, sonra geçmiş, sonuç özeti ve en az sapan işaretli satırlar kısaltılır
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "6000"))
+# Bundan az yer kalınca referans bölümü yarım kesilmez, atlanır
+REFERENCE_MIN_TOKENS = 150
+ANALYSIS_CACHE_FILE = os.environ.get("ANALYSIS_CACHE_FILE", os.path.join("cache", "analyses.sqlite"))
+ANALYSIS_CACHE_TTL_SECONDS = float(os.environ.get("ANALYSIS_CACHE_TTL_HOURS", "24")) * 3600
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_MB", "32")) * 1024 * 1024
+
+def normalize_cell(value, role=None):
+    text = "" if pd.isna(value) else " ".join(str(value).split())
+    if role == 'test':
+        return normalize_test_name(text)
+    if role in ('result', 'reference'):
+        text = text.replace(',', '.').replace(' ', '')
+        # 5.30 ile 5.3 aynı sonuç sayılır
+        return re.sub(r'-?\d+(?:\.\d+)?', lambda m: f"{float(m.group()):g}", text).lower()
+    if role == 'unit':
+        return text.replace('/', ' ').lower()
+    return text
+
+def analysis_fingerprint(df):
+    """Satır sırası, sayı yazımı ve birim biçiminden bağımsız tablo özeti üretir"""
+    roles = {col: role for role, col in lab_column_roles(df).items()}
+    columns = sorted(df.columns, key=lambda col: (roles.get(col, '~'), str(col)))
+    rows = sorted(
+        tuple(normalize_cell(value, roles.get(col)) for col, value in zip(columns, row))
+        for row in df[columns].itertuples(index=False)
+    )
+    payload = json.dumps({
+        'columns': [roles.get(col, normalize_test_name(col)) for col in columns],
+        'rows': rows,
+        'prompt_version': PROMPT_TEMPLATE_VERSION,
+        'model': GEMINI_MODEL,
+    }, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def analysis_cache_key(df, patient_id=None):
+    """Hasta verildiyse tablo özetine hastayı ve geçmişinin sürümünü ekler; yeni rapor gelince eski analiz kullanılmaz"""
+    fingerprint = analysis_fingerprint(df)
+    roles = lab_column_roles(df)
+    if not patient_id or 'test' not in roles:
+        return fingerprint
+    patient_hash = hashlib.sha256(str(patient_id).encode('utf-8')).hexdigest()[:16]
+    try:
+        revision = results_store.revision(patient_id, df[roles['test']].dropna().astype(str).unique())
+    except sqlite3.Error as e:
+        print(f"Sonuç geçmişi okunamadı: {e}")
+        revision = ""
+    return f"{fingerprint}-{patient_hash}-{revision}"
+
+class AnalysisCache:
+    """Tamamlanmış analiz raporlarını TTL ve boyut sınırıyla SQLite'ta saklar"""
+
+    def __init__(self, path, ttl_seconds, max_bytes):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                "key TEXT PRIMARY KEY, report TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            row = conn.execute(
+                "SELECT report FROM analyses WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                record_cache_lookup('analysis', misses=1)
+                return None
+            conn.execute("UPDATE analyses SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+            record_cache_lookup('analysis', hits=1)
+            return row[0]
+
+    def put(self, key, report):
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, report, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, report, now, now)
+            )
+            conn.execute("DELETE FROM analyses WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(LENGTH(CAST(report AS BLOB))), 0) FROM analyses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        target = int(self.max_bytes * 0.9)
+        rows = conn.execute(
+            "SELECT key, LENGTH(CAST(report AS BLOB)) FROM analyses ORDER BY last_used"
+        ).fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= target:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM analyses WHERE key = ?", stale)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_FILE, ANALYSIS_CACHE_TTL_SECONDS, ANALYSIS_CACHE_MAX_BYTES)
+
+TOKEN_PATTERN = re.compile(r'\w{1,4}|[^\w\s]')
+
+def estimate_tokens(text):
+    """Ağ çağrısı yapmadan token sayısını tahmin eder; uzun Türkçe kelimeler 4 harflik parçalara bölünür"""
+    return len(TOKEN_PATTERN.findall(text)) if text else 0
+
+def truncate_to_tokens(text, max_tokens):
+    """Metni satır sınırında keser; hiçbir satır sığmazsa boş döner"""
+    lines = []
+    used = 0
+    for line in text.split("\n"):
+        tokens = estimate_tokens(line)
+        if used + tokens > max_tokens:
+            break
+        lines.append(line)
+        used += tokens
+    return "\n".join(lines).strip()
+
+UNRATED_LABEL = "Değerlendirilemedi"
+
+def flag_severity(detailed):
+    """İşaretli satırların referans sınırından göreli sapması; tablodaki değerlendirilemeyen satırlar en düşük önceliktedir"""
+    over = (detailed['value'] - detailed['high']) / detailed['high'].abs()
+    under = (detailed['low'] - detailed['value']) / detailed['low'].abs()
+    severity = over.where(detailed['flag'] == 'high', under.where(detailed['flag'] == 'low'))
+    # Sayısal olmayan işaretli sonuçların (ör. "Pozitif") sapması ölçülemez
+    severity = severity.fillna(0.0)
+    return severity.where(detailed['flag'].isin(['high', 'low']), -1.0)
+
+def compact_lab_table(df, flags):
+    """İşaretli ve referansı yorumlanamayan satırları ayrıntılı tablo için ayırır; normal ve referanssız sonuçlar özet listelerine girer.
+    Sütunlar tanınmadıysa tablo None döner"""
+    if flags.empty:
+        return None, [], []
+    
+    abnormal = flags['flag'].isin(['high', 'low'])
+    flagged_tests = {normalize_test_name(test) for test in flags.loc[abnormal, 'test'].dropna()}
+    seen = set()
+    normal_results = []
+    unreferenced_results = []
+    unrated_index = []
+    for row_index, row in zip(flags.index[~abnormal], flags[~abnormal].itertuples(index=False)):
+        # Sonucu boş satırlar panel başlıklarıdır
+        if pd.isna(row.test) or pd.isna(row.result) or is_header_row([row.test]):
+            continue
+        key = normalize_test_name(row.test)
+        # Aynı testin farklı tarihlerdeki sonuçları ve işaretli testlerin normal ölçümleri tekrar yazılmaz
+        if key in seen or key in flagged_tests:
+            continue
+        seen.add(key)
+        if row.flag == 'normal':
+            normal_results.append(f"{row.test} {row.result}")
+        elif pd.isna(row.reference):
+            unit = "" if pd.isna(row.unit) else f" {row.unit}"
+            unreferenced_results.append(f"{row.test} {row.result}{unit}")
+        else:
+            # Referans metni ("40 *", "Negatif <1") modelin yorumlayabilmesi için birlikte gönderilir
+            unrated_index.append(row_index)
+    
+    detailed = flags[abnormal | flags.index.isin(unrated_index)]
+    return detailed.assign(severity=flag_severity(detailed)), normal_results, unreferenced_results
+
+def lab_table_markdown(detailed):
+    if detailed.empty:
+        return "Referans aralığı dışında sonuç bulunmadı."
+    table = pd.DataFrame({
+        'Tarih': detailed['date'],
+        'Tahlil': detailed['test'],
+        'Sonuç': detailed['result'],
+        'Birim': detailed['unit'],
+        'Referans': detailed['reference'],
+        'Durum': detailed['flag'].map(STATUS_LABELS).fillna(UNRATED_LABEL),
+    }).astype(object).fillna("")
+    return table.to_markdown(index=False)
+
+def summary_line(label, results, detailed=True):
+    """Sonuç grubunu tek satırda özetler; detailed=False ise yalnızca sayı yazılır"""
+    if not results:
+        return ""
+    items = f": {', '.join(results)}" if detailed else ""
+    return f"{label} ({len(results)} test){items}"
+
+def results_summary_text(normal_results, unreferenced_results=(), detailed=True):
+    lines = [
+        summary_line("Normal aralıktaki diğer sonuçlar", normal_results, detailed),
+        summary_line("Referans aralığı olmayan diğer sonuçlar", unreferenced_results, detailed),
+    ]
+    return "\n".join(line for line in lines if line)
+
+def omitted_results_text(omitted_rows, detailed=True):
+    """Bütçeye sığmadığı için tablodan çıkarılan işaretli satırları adı ve durumuyla özetler"""
+    results = [
+        f"{row.test} {row.result} ({STATUS_LABELS.get(row.flag, UNRATED_LABEL)})"
+        for row in omitted_rows.itertuples(index=False)
+    ]
+    return summary_line("Bütçe nedeniyle tabloya alınmayan diğer sonuçlar", results, detailed)
+
+def build_analysis_prompt(lab_table, relevant_references, lab_history="", results_summary=""):
+    return f"""
+        Aşağıdaki tabloda referans aralığı dışındaki ve otomatik değerlendirilemeyen ("{UNRATED_LABEL}") laboratuvar sonuçları var; sonuçları referanslarıyla karşılaştırıp fazla ya da düşük değerleri analiz et:
         
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
-        )
+        {lab_table}
         
-        analysis_prompt = f"""
-        Aşağıdaki tablo verilerini analiz et ve fazla ya da düşük değerleri tespit et:
+        {results_summary}
         
-        {markdown_content}
+        {lab_history}
         
         Lütfen şunları analiz et:
         1. Hangi değerler normal aralığın dışında?
@@ -304,37 +2689,244 @@ def analyze_with_gemini(df):
         - Nasıl düzeltileceği
         - Hangi doktora başvurulması gerektiği
         - Yaşam tarzı değişiklikleri
+        {"Önceki sonuçlar verildiyse değerlerin zaman içindeki seyrini de yorumla." if lab_history else ""}
         
         Türkçe olarak detaylı bir analiz raporu hazırla.
         """
-        
-        model = "gemini-2.5-flash"
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=analysis_prompt),
-                ],
-            ),
-        ]
-        generate_content_config = types.GenerateContentConfig(
-            thinking_config = types.ThinkingConfig(
-                thinking_budget=0,
-            ),
-        )
 
-        analysis_result = ""
-        for chunk in client.models.generate_content_stream(
-            model=model,
+def prepare_lab_table(df, flags):
+    """Satır ayrımını ve tam tablonun markdown çizimini referans ve geçmişten bağımsız olarak hazırlar"""
+    detailed, normal_results, unreferenced_results = compact_lab_table(df, flags)
+    lab_table = df.to_markdown(index=False) if detailed is None else lab_table_markdown(detailed)
+    return detailed, normal_results, unreferenced_results, lab_table
+
+def compact_analysis_prompt(df, references, lab_history="", flags=None, budget=None, prepared=None):
+    """İstemi token bütçesine sığdırır: işaretli satırlar önceliklidir, gerekirse en az sapanlar tablodan özete iner;
+    geçmiş ve referanslar öncelik sırasıyla kalan yere girer. prepared, prepare_lab_table sonucudur"""
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    flags = flag_lab_values(df) if flags is None else flags
+    if prepared is None:
+        prepared = prepare_lab_table(df, flags)
+    detailed, normal_results, unreferenced_results, lab_table = prepared
+    
+    def template_tokens(lab_table, results_summary):
+        # Boşlukla birleşen parçaların tahminleri toplanabilir; şablon bir kez ölçülür.
+        # Geçmiş eklenince çıkan ek cümle de sayılsın diye yer tutucu verilir
+        return estimate_tokens(build_analysis_prompt(lab_table, "", "x", results_summary))
+    
+    if detailed is None:
+        # Sütunlar tanınmadıysa tablo olduğu gibi, sığdığı kadar gönderilir
+        lab_table = truncate_to_tokens(lab_table, budget - template_tokens("", ""))
+        results_summary = ""
+        used = template_tokens(lab_table, results_summary)
+    else:
+        results_summary = results_summary_text(normal_results, unreferenced_results)
+        used = template_tokens(lab_table, results_summary)
+        if used > budget and results_summary:
+            results_summary = results_summary_text(normal_results, unreferenced_results, detailed=False)
+            used = template_tokens(lab_table, results_summary)
+    
+    if used > budget and detailed is not None and not detailed.empty:
+        # Tablo tek başına bütçeyi aşıyorsa en az sapan satırlar adıyla özete iner; kalan satırlar rapor sırasını korur
+        by_severity = detailed.sort_values('severity', ascending=False, kind='stable')
+        
+        def fit(kept_rows, detailed_omitted=True):
+            kept = detailed.loc[detailed.index.isin(by_severity.index[:kept_rows])]
+            omitted = omitted_results_text(by_severity.iloc[kept_rows:], detailed_omitted)
+            summary = "\n".join(text for text in (omitted, results_summary) if text)
+            table = lab_table_markdown(kept) if kept_rows else "Tabloya sığan satır kalmadı; işaretli sonuçlar aşağıda özetlendi."
+            return table, summary, template_tokens(table, summary), kept_rows
+        
+        low, high = 0, len(by_severity) - 1
+        best = None
+        while low <= high:
+            middle = (low + high) // 2
+            candidate = fit(middle)
+            if candidate[2] <= budget:
+                best = candidate
+                low = middle + 1
+            else:
+                high = middle - 1
+        if best is None:
+            best = fit(0, detailed_omitted=False)
+        lab_table, results_summary, used, kept_rows = best
+        detailed = detailed.loc[detailed.index.isin(by_severity.index[:kept_rows])]
+    
+    lab_history = truncate_to_tokens(lab_history, budget - used) if lab_history else ""
+    # Yalnızca başlık sığdıysa geçmiş eklenmez
+    if "\n" not in lab_history:
+        lab_history = ""
+    used += estimate_tokens(lab_history)
+    
+    kept = []
+    for reference in references:
+        remaining = budget - used
+        tokens = estimate_tokens(reference)
+        if tokens > remaining:
+            if remaining >= REFERENCE_MIN_TOKENS:
+                kept.append(truncate_to_tokens(reference, remaining))
+            break
+        kept.append(reference)
+        used += tokens
+    
+    prompt = build_analysis_prompt(lab_table, "\n\n".join(kept), lab_history, results_summary)
+    estimated_tokens = estimate_tokens(prompt)
+    if estimated_tokens > budget:
+        print(f"Analiz istemi token bütçesini aşıyor: ~{estimated_tokens} > {budget}")
+    if detailed is None:
+        flagged_rows, table_flagged, table_rows = len(df), len(df), len(df)
+    else:
+        flagged_rows = int(flags['flag'].isin(['high', 'low']).sum())
+        table_flagged = int(detailed['flag'].isin(['high', 'low']).sum())
+        table_rows = len(detailed)
+    return prompt, {
+        'estimated_tokens': estimated_tokens,
+        'budget': budget,
+        'within_budget': estimated_tokens <= budget,
+        'flagged_rows': flagged_rows,
+        'omitted_flagged_rows': flagged_rows - table_flagged,
+        'unrated_rows': table_rows - table_flagged,
+        'summarized_tests': len(normal_results) + len(unreferenced_results),
+        'references_kept': len(kept),
+        'references_total': len(references),
+    }
+
+def build_generation_request(analysis_prompt):
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=analysis_prompt),
+            ],
+        ),
+    ]
+    generate_content_config = types.GenerateContentConfig(
+        thinking_config = types.ThinkingConfig(
+            thinking_budget=0,
+        ),
+    )
+    return contents, generate_content_config
+
+async def build_analysis_prompt_async(df, patient_id=None):
+    """Tespit, paralel referans araması ve geçmiş sorgusunu eşzamanlı yürütüp istemi bütçeye sığdırır"""
+    with span('flagging', rows=len(df)) as info:
+        flags = await asyncio.to_thread(flag_lab_values, df)
+        abnormal_values = detect_abnormal_values(df, flags)
+        info['abnormal'] = len(abnormal_values)
+    
+    # Referans aramaları sürerken geçmiş sorgusu ve tablonun hazırlanması da devam eder
+    (references, references_complete), lab_history, prepared = await asyncio.gather(
+        collect_references_async(abnormal_values),
+        asyncio.to_thread(lab_history_text, abnormal_values, patient_id),
+        asyncio.to_thread(prepare_lab_table, df, flags),
+    )
+    
+    prompt, info = await asyncio.to_thread(compact_analysis_prompt, df, references, lab_history, flags, None, prepared)
+    info['references_complete'] = references_complete
+    print(f"Analiz istemi: ~{info['estimated_tokens']} token (bütçe {info['budget']}), "
+          f"{info['flagged_rows']} işaretli ({info['omitted_flagged_rows']} özette), "
+          f"{info['unrated_rows']} değerlendirilemeyen satır, "
+          f"{info['summarized_tests']} test özetlendi, "
+          f"{info['references_kept']}/{info['references_total']} referans")
+    return prompt, info
+
+async def stream_analysis_async(df, patient_id=None, raise_errors=False):
+    """Gemini analizini parça parça üretir; her adımda o ana kadar oluşan metni verir. Geçmiş yalnızca hasta kimliğiyle eklenir.
+    raise_errors verilirse hata metni üretmek yerine istisna fırlatılır (toplu işleme için)"""
+    if df.empty:
+        yield "Analiz edilecek veri bulunamadı."
+        return
+    
+    analysis_result = ""
+    # Üreteç her parçada çağırana döndüğü için izleme yalnızca yield içermeyen bloklarda etkinleştirilir
+    trace = Trace('analysis', rows=len(df))
+    try:
+        with trace.activate():
+            cache_key = await asyncio.to_thread(analysis_cache_key, df, patient_id)
+            try:
+                cached_report = await asyncio.to_thread(analysis_cache.get, cache_key)
+            except sqlite3.Error as e:
+                print(f"Analiz önbelleği okunamadı: {e}")
+                cached_report = None
+        if cached_report is not None:
+            trace.attributes['cached'] = True
+            yield cached_report
+            return
+        
+        with trace.activate():
+            with span('prompt_build') as info:
+                analysis_prompt, prompt_info = await build_analysis_prompt_async(df, patient_id)
+                info.update(prompt_info)
+            metrics.inc('publica_tokens_total', prompt_info['estimated_tokens'], kind='prompt_estimate')
+        
+        client = services.gemini()
+        contents, generate_content_config = build_generation_request(analysis_prompt)
+
+        started_at = time.time()
+        start = time.perf_counter()
+        first_token_time = None
+        usage = None
+        async for chunk in stream_with_retry_async(
+            client.aio.models.generate_content_stream,
+            model=GEMINI_MODEL,
             contents=contents,
             config=generate_content_config,
         ):
+            # Token sayıları genellikle yalnızca son parçada gelir
+            usage = getattr(chunk, 'usage_metadata', None) or usage
+            if not chunk.text:
+                continue
+            if first_token_time is None:
+                first_token_time = time.perf_counter() - start
+                metrics.observe('publica_stage_seconds', first_token_time, stage='generation_first_chunk')
             analysis_result += chunk.text
-        
-        return analysis_result
-        
+            yield analysis_result
+        
+        total_time = time.perf_counter() - start
+        prompt_tokens = getattr(usage, 'prompt_token_count', None) or 0
+        response_tokens = getattr(usage, 'candidates_token_count', None) or 0
+        metrics.inc('publica_tokens_total', prompt_tokens, kind='prompt')
+        metrics.inc('publica_tokens_total', response_tokens, kind='response')
+        with trace.activate():
+            record_span('generation', started_at, total_time, {
+                'first_chunk_s': round(first_token_time or total_time, 4),
+                'prompt_tokens': prompt_tokens,
+                'response_tokens': response_tokens,
+            })
+        print(f"Gemini üretimi: ilk parça {first_token_time or total_time:.2f} sn, toplam {total_time:.2f} sn")
+        
+        if analysis_result and not prompt_info['references_complete']:
+            # Eksik referanslarla yazılan rapor, indeks hazır olunca yapılacak tam analizin yerini almasın
+            trace.attributes['cache_skipped'] = 'incomplete_references'
+            print("Referans araması eksik kaldı; analiz önbelleğe yazılmadı")
+        elif analysis_result:
+            try:
+                await asyncio.to_thread(analysis_cache.put, cache_key, analysis_result)
+            except sqlite3.Error as e:
+                print(f"Analiz önbelleğine yazılamadı: {e}")
+        
+    except (GeneratorExit, asyncio.CancelledError):
+        trace.attributes['status'] = 'cancelled'
+        raise
     except Exception as e:
-        return f"Analiz sırasında hata oluştu: {str(e)}"
+        trace.attributes.update(status='error', error=str(e))
+        if raise_errors:
+            raise
+        error_message = f"Analiz sırasında hata oluştu: {str(e)}"
+        # Yarıda kesilen akışta o ana kadar gelen metin korunur
+        yield f"{analysis_result}\n\n{error_message}" if analysis_result else error_message
+    finally:
+        trace.finish(cached=trace.attributes.get('cached', False))
+
+def stream_analysis(df, patient_id=None):
+    """stream_analysis_async için senkron sarmalayıcı"""
+    yield from iterate_async_generator(lambda: stream_analysis_async(df, patient_id))
+
+def analyze_with_gemini(df, patient_id=None):
+    analysis_result = ""
+    for analysis_result in stream_analysis(df, patient_id):
+        pass
+    return analysis_result
 
 def update_interface(pdf_file):
     if pdf_file is None:
@@ -344,6 +2936,30 @@ def update_interface(pdf_file):
     
     return pdf_file, df
 
+# Arayüz kuyrukları: çıkarma CPU'ya, analiz ağ beklemesine, sayfa görüntüleme belleğe bağlı
+ANALYSIS_CONCURRENCY = int(os.environ.get("ANALYSIS_CONCURRENCY", "16"))
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", "8"))
+QUEUE_MAX_SIZE = int(os.environ.get("QUEUE_MAX_SIZE", "64"))
+
+INDEX_STAGE_LABELS = {
+    'starting': 'başlatılıyor',
+    'reading': 'referans dosyaları okunuyor',
+    'embedding': 'bölümler gömülüyor',
+    'upserting': 'vektörler yükleniyor',
+}
+
+def index_status_text():
+    """Arayüzdeki indeks durum satırı; indeks hazırsa boş döner"""
+    index = reference_index_status.snapshot()
+    if index['state'] == 'running':
+        progress = f" ({index['done']}/{index['total']})" if index['total'] else ""
+        stage = INDEX_STAGE_LABELS.get(index['stage'], index['stage'] or "")
+        return (f"⏳ Referans indeksi hazırlanıyor: {stage}{progress}. "
+                "Bu sırada analizler yalnızca yerel referans metinleriyle yapılır.")
+    if index['state'] == 'failed':
+        return "⚠️ Referans indeksi hazırlanamadı; analizler yerel referans metinleriyle yapılıyor."
+    return ""
+
 def load_example_pdf():
     """Örnek PDF dosyasını yükler"""
     example_pdf_path = "Enabiz-Tahlilleri.pdf"
@@ -351,7 +2967,15 @@ def load_example_pdf():
         return example_pdf_path
     return None
 
+def release_document(document):
+    if document:
+        page_renderer.release(document['path'], document['holder'])
+
 def create_interface():
+    import gradio as gr
+    
+    # Gradio'nun önbelleğe kopyaladığı yüklemeler ve indirmeler de dışa aktarımlarla aynı sürede silinir
+    delete_cache = (EXPORT_TTL_SECONDS, EXPORT_TTL_SECONDS)
     with gr.Blocks(title="Publica - Tıbbi Rapor Analizi", theme=gr.themes.Soft(), css="""
         .pdf-nav-row {
             display: flex !important;
@@ -501,10 +3125,14 @@ def create_interface():
             text-align: center !important;
             margin-bottom: 0 !important;
         }
-    """) as demo:
+    """, delete_cache=delete_cache) as demo:
         gr.Markdown("# 🏥 Publica - Tıbbi Rapor Analizi")
         gr.Markdown("Laboratuvar raporlarınızı yükleyin ve anormal değerleri otomatik olarak tespit edin.")
         
+        status_text = index_status_text()
+        index_status = gr.Markdown(value=status_text, visible=bool(status_text))
+        status_timer = gr.Timer(2.0, active=reference_index_status.snapshot()['state'] == 'running')
+        
         with gr.Row():
             with gr.Column(scale=1):
                 gr.Markdown("## 📖 Laboratuvar Raporu Önizleme")
@@ -541,7 +3169,8 @@ def create_interface():
                     )
                     next_btn = gr.Button("➡️", size="sm", scale=1, interactive=False)
                 
-                pdf_pages = gr.State([])
+                # Sekme kapanınca oturumun sayfa belleği hemen bırakılır
+                pdf_document = gr.State(None, delete_callback=release_document)
                 current_page = gr.State(0)
             
             with gr.Column(scale=2):
@@ -583,6 +3212,11 @@ def create_interface():
                         elem_classes="analysis-result"
                     )
         
+        def refresh_index_status():
+            text = index_status_text()
+            running = reference_index_status.snapshot()['state'] == 'running'
+            return gr.update(value=text, visible=bool(text)), gr.Timer(active=running)
+        
         def load_example():
             """Örnek PDF dosyasını yükler"""
             example_path = load_example_pdf()
@@ -590,39 +3224,50 @@ def create_interface():
                 return example_path
             return None
         
-        def on_pdf_upload(pdf_file):
+        def on_pdf_upload(pdf_file, previous_document):
+            # Aynı oturumda yeni dosya seçilince önceki belge bırakılır; State yalnızca oturum sonunda silinir
+            release_document(previous_document)
             if pdf_file is None:
                 return (
                     None,  # PDF görüntü
-                    [],  # PDF sayfaları
+                    None,  # PDF belge bilgisi
                     0,  # Mevcut sayfa
                     "- / -",  # Sayfa bilgisi
                     gr.update(interactive=False),  # Sol ok disabled
                     gr.update(interactive=False)  # Sağ ok disabled
                 )
             
-            pages = get_pdf_pages(pdf_file)
+            # Belge açılmadan önce sahiplenilir; başka bir oturumun bırakması araya giremez
+            holder = uuid.uuid4().hex
+            page_renderer.acquire(pdf_file, holder)
+            try:
+                page_count = page_renderer.page_count(pdf_file)
+                first_page = page_renderer.get_page(pdf_file, 0) if page_count else None
+            except Exception as e:
+                print(f"PDF sayfa oluşturma hatası: {e}")
+                page_count, first_page = 0, None
             
-            if not pages:
+            if first_page is None:
+                page_renderer.release(pdf_file, holder)
                 return (
                     None,
-                    [],
+                    None,
                     0,
                     "- / -",
                     gr.update(interactive=False),
                     gr.update(interactive=False)
                 )
 
-            first_page = pages[0]
-            page_info_text = f"1 / {len(pages)}"
+            document = {'path': pdf_file, 'page_count': page_count, 'holder': holder}
+            page_info_text = f"1 / {page_count}"
             
             return (
                 first_page,
-                pages,
+                document,
                 0,
                 page_info_text,
                 gr.update(interactive=False),
-                gr.update(interactive=len(pages) > 1)
+                gr.update(interactive=page_count > 1)
             )
         
         def extract_tables(pdf_file):
@@ -634,18 +3279,10 @@ def create_interface():
                     gr.update(visible=False)
                 )
             
+            # Arayüz birden çok kullanıcıya açık ve hasta kimliği sormuyor; sonuçlar geçmişe eklenmez
             df, message = process_pdf(pdf_file)
             
-            csv_file = None
-            if not df.empty:
-                temp_dir = "temp"
-                if not os.path.exists(temp_dir):
-                    os.makedirs(temp_dir)
-                
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                csv_filename = f"{timestamp}.csv"
-                csv_file = os.path.join(temp_dir, csv_filename)
-                df.to_csv(csv_file, index=False, encoding='utf-8-sig')
+            csv_file = export_csv(df) if not df.empty else None
             
             return (
                 df,
@@ -654,23 +3291,30 @@ def create_interface():
                 gr.update(visible=False)
             )
         
-        def analyze_data(df):
+        def format_analysis(analysis):
+            return f"""
+## 🏥 Tıbbi Analiz Raporu
+
+{analysis}
+            """
+        
+        async def analyze_data(df):
             if df.empty:
-                return (
+                yield (
                     gr.update(visible=False, value="Analiz edilecek veri bulunamadı."),
                     gr.update(interactive=True, value="🏥 Tıbbi Analiz Yap")
                 )
+                return
             
-            analysis = analyze_with_gemini(df)
-            
-            formatted_analysis = f"""
-## 🏥 Tıbbi Analiz Raporu
-
-{analysis}
-            """
+            analysis = ""
+            async for analysis in stream_analysis_async(df):
+                yield (
+                    gr.update(visible=True, value=format_analysis(analysis)),
+                    gr.update(interactive=False, value="⏳ Tıbbi Analiz Yapılıyor...")
+                )
             
-            return (
-                gr.update(visible=True, value=formatted_analysis),
+            yield (
+                gr.update(visible=True, value=format_analysis(analysis)),
                 gr.update(interactive=True, value="🔍 Analiz Et")
             )
         
@@ -686,73 +3330,103 @@ def create_interface():
                 gr.update(interactive=False, value="⏳ Tıbbi Analiz Yapılıyor...")
             )
         
-        def go_to_previous_page(pages, current):
-            if not pages or current <= 0:
-                return gr.update()
-            new_page = current - 1
+        def show_page(document, new_page):
+            page_count = document['page_count']
             return (
-                pages[new_page],  # PDF görüntü
+                page_renderer.get_page(document['path'], new_page),  # PDF görüntü
                 new_page,  # Mevcut sayfa
-                f"{new_page + 1} / {len(pages)}",  # Sayfa bilgisi
+                f"{new_page + 1} / {page_count}",  # Sayfa bilgisi
                 gr.update(interactive=new_page > 0),  # Sol ok durumu
-                gr.update(interactive=new_page < len(pages) - 1)  # Sağ ok durumu
+                gr.update(interactive=new_page < page_count - 1)  # Sağ ok durumu
             )
         
-        def go_to_next_page(pages, current):
-            if not pages or current >= len(pages) - 1:
+        def go_to_previous_page(document, current):
+            if not document or current <= 0 or not os.path.exists(document['path']):
                 return gr.update()
-            new_page = current + 1
-            return (
-                pages[new_page],  # PDF görüntü
-                new_page,  # Mevcut sayfa
-                f"{new_page + 1} / {len(pages)}",  # Sayfa bilgisi
-                gr.update(interactive=new_page > 0),  # Sol ok durumu
-                gr.update(interactive=new_page < len(pages) - 1)  # Sağ ok durumu
-            )
+            return show_page(document, current - 1)
+        
+        def go_to_next_page(document, current):
+            if not document or current >= document['page_count'] - 1 or not os.path.exists(document['path']):
+                return gr.update()
+            return show_page(document, current + 1)
+        
+        status_timer.tick(
+            fn=refresh_index_status,
+            outputs=[index_status, status_timer],
+            queue=False
+        )
+        
+        demo.load(
+            fn=refresh_index_status,
+            outputs=[index_status, status_timer],
+            queue=False
+        )
         
         pdf_preview.change(
             fn=on_pdf_upload,
-            inputs=[pdf_preview],
-            outputs=[pdf_display, pdf_pages, current_page, page_info, prev_btn, next_btn]
+            inputs=[pdf_preview, pdf_document],
+            outputs=[pdf_display, pdf_document, current_page, page_info, prev_btn, next_btn],
+            concurrency_limit=RENDER_CONCURRENCY,
+            concurrency_id="rendering"
         )
         
+        # Uzun süren çıkarma işleri analiz ve sayfa gezinmesini bekletmesin
         process_btn.click(
             fn=extract_tables,
             inputs=[pdf_preview],
-            outputs=[dataframe_display, csv_download, analyze_btn, analysis_result]
+            outputs=[dataframe_display, csv_download, analyze_btn, analysis_result],
+            concurrency_limit=EXTRACTION_WORKERS,
+            concurrency_id="extraction",
+            show_progress="full"
         )
         
         analyze_btn.click(
             fn=start_analysis,
             inputs=[dataframe_display],
-            outputs=[analysis_result, analyze_btn]
+            outputs=[analysis_result, analyze_btn],
+            concurrency_limit=None,
+            queue=False
         ).then(
             fn=analyze_data,
             inputs=[dataframe_display],
-            outputs=[analysis_result, analyze_btn]
+            outputs=[analysis_result, analyze_btn],
+            concurrency_limit=ANALYSIS_CONCURRENCY,
+            concurrency_id="analysis",
+            show_progress="full"
         )
         
         prev_btn.click(
             fn=go_to_previous_page,
-            inputs=[pdf_pages, current_page],
-            outputs=[pdf_display, current_page, page_info, prev_btn, next_btn]
+            inputs=[pdf_document, current_page],
+            outputs=[pdf_display, current_page, page_info, prev_btn, next_btn],
+            concurrency_limit=RENDER_CONCURRENCY,
+            concurrency_id="rendering"
         )
         
         next_btn.click(
             fn=go_to_next_page,
-            inputs=[pdf_pages, current_page],
-            outputs=[pdf_display, current_page, page_info, prev_btn, next_btn]
+            inputs=[pdf_document, current_page],
+            outputs=[pdf_display, current_page, page_info, prev_btn, next_btn],
+            concurrency_limit=RENDER_CONCURRENCY,
+            concurrency_id="rendering"
         )
         
         example_btn.click(
             fn=load_example,
-            outputs=[pdf_preview]
+            outputs=[pdf_preview],
+            concurrency_limit=None,
+            queue=False
         ).then(
             fn=on_pdf_upload,
-            inputs=[pdf_preview],
-            outputs=[pdf_display, pdf_pages, current_page, page_info, prev_btn, next_btn]
+            inputs=[pdf_preview, pdf_document],
+            outputs=[pdf_display, pdf_document, current_page, page_info, prev_btn, next_btn],
+            concurrency_limit=RENDER_CONCURRENCY,
+            concurrency_id="rendering"
         )
     
+    # Kuyruk dolunca yeni istekler reddedilir; bekleyenler sıradaki yerlerini görür
+    demo.queue(max_size=QUEUE_MAX_SIZE, default_concurrency_limit=1)
+    
     return demo
 
 def test_gemini_embedding():
@@ -768,19 +3442,72 @@ def test_gemini_embedding():
         print("❌ Gemini embedding başarısız!")
         return False
 
-if __name__ == "__main__":
-    print("Gemini embedding test ediliyor...")
+def run_startup_tasks():
+    """Referans indekslemesini ve dönüştürücü hazırlığını arayüzü bekletmeden yürütür"""
     if test_gemini_embedding():
         print("Kan tahlili referans bilgileri yükleniyor...")
         load_and_index_lab_reference()
-        print("Referans bilgileri başarıyla yüklendi.")
-        
-        demo = create_interface()
-        demo.launch(
-            server_name="0.0.0.0",
-            server_port=7860,
-            share=False,
-            show_error=True
-        )
+        if reference_index_status.snapshot()['state'] == 'ready':
+            print("Referans bilgileri başarıyla yüklendi.")
     else:
-        print("Gemini embedding testi başarısız. Lütfen API anahtarınızı kontrol edin.")
\ No newline at end of file
+        reference_index_status.finish("Gemini embedding testi başarısız")
+        print("Gemini embedding testi başarısız. Lütfen API anahtarınızı kontrol edin.")
+    
+    removed = cleanup_exports()
+    if removed:
+        print(f"Süresi dolan {removed} CSV dışa aktarımı silindi.")
+    
+    try:
+        get_lexical_index()
+    except Exception as e:
+        print(f"Sözcük indeksi hazırlama hatası: {e}")
+    
+    print(f"PDF dönüştürücü havuzu hazırlanıyor ({converter_pool.size} adet)...")
+    try:
+        converter_pool.warm_up()
+    except Exception as e:
+        print(f"PDF dönüştürücü hazırlama hatası: {e}")
+
+def start_background_startup():
+    # Arayüz açılmadan önce işaretlenir ki ilk istekler yarım indekste arama yapmasın
+    reference_index_status.start()
+    thread = threading.Thread(target=run_startup_tasks, name="startup", daemon=True)
+    thread.start()
+    return thread
+
+def health_report():
+    """Sağlık ve hazır olma uçları için indeksleme ilerlemesini ve havuz durumunu toplar"""
+    index = reference_index_status.snapshot()
+    return {
+        'status': 'starting' if index['state'] == 'running' else 'ok',
+        'degraded': index['state'] == 'failed',
+        'reference_index': index,
+        'converter_pool': converter_pool.stats(),
+    }
+
+if __name__ == "__main__":
+    import gradio as gr
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, PlainTextResponse
+    
+    start_background_startup()
+    
+    server = FastAPI()
+    
+    @server.get("/health")
+    def health():
+        return health_report()
+    
+    @server.get("/metrics")
+    def metrics_endpoint():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+    
+    @server.get("/ready")
+    def ready():
+        report = health_report()
+        return JSONResponse(report, status_code=503 if report['status'] == 'starting' else 200)
+    
+    demo = create_interface()
+    server = gr.mount_gradio_app(server, demo, path="/", show_error=True)
+    uvicorn.run(server, host="0.0.0.0", port=7860)
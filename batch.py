@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+# Her işçi süreci aynı anda tek PDF dönüştürür; fazladan dönüştürücü yüklemesin
+os.environ.setdefault("CONVERTER_POOL_SIZE", "1")
+# Paralellik PDF'ler arasında; her PDF'i ayrıca sayfa sayfa bölmek çekirdekleri aşırı doldurur
+os.environ.setdefault("PDF_CONVERSION_PROCESSES", "1")
+
+from app import detect_abnormal_values, file_sha256, process_pdf, stream_analysis_async
+
+RESULTS_FILE = "results.jsonl"
+SUCCESS_MESSAGE = "PDF başarıyla işlendi"
+
+def collect_pdfs(source):
+    """Dizindeki PDF'leri veya manifest dosyasında satır satır listelenen yolları döndürür"""
+    if os.path.isdir(source):
+        pdfs = []
+        for root, _, files in os.walk(source):
+            pdfs.extend(os.path.join(root, name) for name in files if name.lower().endswith('.pdf'))
+        return sorted(pdfs)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [
+        line if os.path.isabs(line) else os.path.join(base_dir, line)
+        for line in lines if line and not line.startswith('#')
+    ]
+
+def load_completed(output_dir):
+    """Önceki çalıştırmalarda başarıyla biten PDF'lerin içerik özetlerini okur"""
+    completed = set()
+    results_path = os.path.join(output_dir, RESULTS_FILE)
+    if not os.path.exists(results_path):
+        return completed
+
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Kesintide yarım kalan son satır
+                continue
+            if record.get('status') in ('ok', 'empty'):
+                completed.add(record['sha256'])
+    return completed
+
+def extract_worker(pdf_path, patient_id=None):
+    """İşçi süreçte çalışır: PDF'i dönüştürür ve anormal değerleri bulur"""
+    start = time.perf_counter()
+    sha256 = file_sha256(pdf_path)
+    df, message = process_pdf(pdf_path, patient_id)
+    abnormal_values = detect_abnormal_values(df) if not df.empty else []
+    return sha256, df, message, abnormal_values, time.perf_counter() - start
+
+async def analyze_async(df, patient_id=None):
+    """Analizi tamamlar; hata veya boş yanıt istisna olur ki kayıt 'error' olsun ve devamda tekrar denensin"""
+    analysis = ""
+    async for analysis in stream_analysis_async(df, patient_id, raise_errors=True):
+        pass
+    if not analysis.strip():
+        raise RuntimeError("Model boş analiz döndürdü")
+    return analysis
+
+def write_table(df, output_dir, name, table_format):
+    tables_dir = os.path.join(output_dir, "tables")
+    os.makedirs(tables_dir, exist_ok=True)
+    table_path = os.path.join(tables_dir, f"{name}.{table_format}")
+    if table_format == "parquet":
+        df.to_parquet(table_path, compression="zstd")
+    else:
+        df.to_csv(table_path, index=False, encoding='utf-8-sig')
+    return os.path.relpath(table_path, output_dir)
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.done / elapsed * 60 if elapsed > 0 else 0.0
+
+    def report(self, pdf_path, status):
+        self.done += 1
+        if status == 'error':
+            self.failed += 1
+        print(f"[{self.done}/{self.total}] {status:<6} {pdf_path} ({self.rate():.1f} PDF/dk)", flush=True)
+
+async def run_batch(pdfs, args):
+    loop = asyncio.get_running_loop()
+    analysis_slots = asyncio.Semaphore(args.analysis_concurrency)
+    # Analiz bekleyen tablolar bellekte birikmesin
+    in_flight = asyncio.Semaphore(args.workers + args.analysis_concurrency * 2)
+    progress = Progress(len(pdfs))
+    results_path = os.path.join(args.output, RESULTS_FILE)
+
+    with open(results_path, 'a', encoding='utf-8') as results, ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+
+        async def handle(pdf_path):
+            async with in_flight:
+                record = {'pdf': pdf_path}
+                try:
+                    sha256, df, message, abnormal_values, extract_seconds = await loop.run_in_executor(
+                        pool, extract_worker, pdf_path, args.patient_id
+                    )
+                    record.update({
+                        'sha256': sha256,
+                        'message': message,
+                        'rows': len(df),
+                        'abnormal_values': abnormal_values,
+                        'extract_seconds': round(extract_seconds, 3),
+                    })
+
+                    if df.empty:
+                        record['status'] = 'empty' if message == SUCCESS_MESSAGE else 'error'
+                    else:
+                        name = f"{os.path.splitext(os.path.basename(pdf_path))[0]}-{sha256[:12]}"
+                        record['table'] = write_table(df, args.output, name, args.format)
+                        if not args.skip_analysis:
+                            async with analysis_slots:
+                                start = time.perf_counter()
+                                record['analysis'] = await analyze_async(df, args.patient_id)
+                                record['analysis_seconds'] = round(time.perf_counter() - start, 3)
+                        record['status'] = 'ok'
+                except Exception as e:
+                    record.update({'status': 'error', 'message': f"Hata: {str(e)}"})
+
+                record['finished_at'] = datetime.now().isoformat(timespec='seconds')
+                # Her sonuç hemen yazılır; kesintide yalnızca yarım kalanlar tekrar işlenir
+                results.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                results.flush()
+                progress.report(pdf_path, record['status'])
+
+        await asyncio.gather(*(handle(pdf_path) for pdf_path in pdfs))
+
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description="Publica toplu laboratuvar raporu işleme")
+    parser.add_argument("source", help="PDF dizini veya her satırında bir PDF yolu olan manifest dosyası")
+    parser.add_argument("-o", "--output", default="batch_output")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Docling dönüşümü için süreç sayısı")
+    parser.add_argument("--analysis-concurrency", type=int, default=4,
+                        help="Aynı anda yapılacak model çağrısı sayısı")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--skip-analysis", action="store_true", help="Yalnızca tabloları çıkar")
+    parser.add_argument("--patient-id", default=None,
+                        help="Tüm raporlar bu hastaya aitse sonuçları geçmişine ekle ve analizde önceki sonuçları kullan")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    pdfs = collect_pdfs(args.source)
+    completed = load_completed(args.output)
+
+    if completed:
+        pending = [
+            pdf_path for pdf_path in pdfs
+            if not os.path.exists(pdf_path) or file_sha256(pdf_path) not in completed
+        ]
+        print(f"{len(pdfs) - len(pending)} PDF önceki çalıştırmada tamamlanmış, atlanıyor.")
+        pdfs = pending
+
+    if not pdfs:
+        print("İşlenecek PDF yok.")
+        return
+
+    print(f"{len(pdfs)} PDF işlenecek ({args.workers} dönüştürme süreci, "
+          f"{args.analysis_concurrency} eşzamanlı analiz)")
+    progress = asyncio.run(run_batch(pdfs, args))
+
+    elapsed = time.perf_counter() - progress.start
+    print(f"Tamamlandı: {progress.done} PDF, {progress.failed} hata, {elapsed:.1f} sn, "
+          f"{progress.rate():.1f} PDF/dk")
+    if progress.failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
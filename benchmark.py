@@ -0,0 +1,643 @@
+import argparse
+import atexit
+from collections import Counter
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+
+# Ölçümler gerçek önbellekleri ve indeksleri kirletmesin diye app yüklenmeden önce geçici dizine yönlendirilir
+BENCH_DIR = tempfile.mkdtemp(prefix="publica-bench-")
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+os.environ["EXTRACTION_CACHE_DIR"] = os.path.join(BENCH_DIR, "extraction")
+os.environ["EMBEDDING_CACHE_FILE"] = os.path.join(BENCH_DIR, "embeddings.sqlite")
+os.environ["ANALYSIS_CACHE_FILE"] = os.path.join(BENCH_DIR, "analyses.sqlite")
+os.environ["REFERENCE_MANIFEST_FILE"] = os.path.join(BENCH_DIR, "reference_manifest.json")
+os.environ["LOCAL_VECTOR_DIR"] = os.path.join(BENCH_DIR, "vectors")
+os.environ["RESULTS_STORE_FILE"] = os.path.join(BENCH_DIR, "results.sqlite")
+os.environ["RETRIEVAL_BACKEND"] = "pinecone"
+
+import fitz  # PyMuPDF
+
+import app
+from app import (
+    EMBEDDING_DIMENSION,
+    LAB_INDEX_NAME,
+    STATUS_LABELS,
+    EmbeddingCache,
+    compact_analysis_prompt,
+    converter_pool,
+    detect_abnormal_values,
+    export_tables_markdown,
+    get_gemini_embedding,
+    get_lexical_index,
+    get_pdf_pages,
+    get_reference_lookup,
+    get_relevant_references,
+    get_retrieval_backend,
+    hybrid_rerank,
+    markdown_to_dataframe,
+    process_pdf,
+    services,
+    stitch_tables,
+    tables_to_dataframe,
+)
+
+DEFAULT_BASELINE_FILE = os.path.join("benchmarks", "baseline.json")
+
+def time_call(fn, repeat, setup=None):
+    """Fonksiyonu tekrar tekrar çalıştırıp en iyi ve ortalama süreyi döndürür"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings), sum(timings) / len(timings)
+
+def peak_memory(fn, setup=None):
+    """Tek çalıştırmada Python yığınındaki en yüksek ek bellek kullanımını (KB) ölçer"""
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+def markdown_path(doc, temp_dir):
+    """Eski yol: markdown dışa aktarımı, geçici dosya ve read_csv"""
+    temp_md_file = os.path.join(temp_dir, "temp_tables.md")
+    with open(temp_md_file, "w", encoding="utf-8") as f:
+        f.write(export_tables_markdown(doc))
+    df = markdown_to_dataframe(temp_md_file)
+    os.remove(temp_md_file)
+    return df
+
+def normalized_rows(df):
+    """İki yolun çıktısını tip ve boşluk farklarından bağımsız karşılaştırmak için"""
+    rows = []
+    for row in df.itertuples(index=False):
+        rows.append(tuple("" if str(v) in ("nan", "<NA>", "None") else str(v).strip() for v in row))
+    return rows
+
+def benchmark_extraction(pdf_path, repeat):
+    print(f"PDF dönüştürülüyor: {pdf_path}")
+    with converter_pool.converter() as converter:
+        doc = converter.convert(pdf_path).document
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        old_df, old_best, old_avg = time_call(lambda: markdown_path(doc, temp_dir), repeat)
+    new_df, new_best, new_avg = time_call(lambda: tables_to_dataframe(doc), repeat)
+
+    print(f"{'Yol':<28}{'En iyi (ms)':>14}{'Ortalama (ms)':>16}{'Satır':>8}")
+    print(f"{'markdown + temp + read_csv':<28}{old_best * 1000:>14.2f}{old_avg * 1000:>16.2f}{len(old_df):>8}")
+    print(f"{'bellekte tablo hücreleri':<28}{new_best * 1000:>14.2f}{new_avg * 1000:>16.2f}{len(new_df):>8}")
+    if new_best > 0:
+        print(f"Hızlanma: {old_best / new_best:.1f}x")
+
+    same_rows = normalized_rows(old_df) == normalized_rows(new_df)
+    print(f"Aynı satırlar: {'evet' if same_rows else 'hayır'}")
+
+def reset_conversion_executor(processes, pages_per_chunk):
+    if app._conversion_executor is not None:
+        app._conversion_executor.shutdown()
+        app._conversion_executor = None
+    app.PDF_CONVERSION_PROCESSES = processes
+    app.PDF_PAGES_PER_CHUNK = pages_per_chunk
+
+def benchmark_parallel(pdf_path, pages, process_counts, pages_per_chunk, repeat):
+    """Sayfa paralel dönüşümü sıralı dönüşümle süre ve çıktı açısından karşılaştırır"""
+    if pdf_path is None:
+        pdf_path = os.path.join(BENCH_DIR, f"synthetic-{pages}p.pdf")
+        make_synthetic_report(pdf_path, pages)
+    print(f"PDF: {pdf_path}, parça başına {pages_per_chunk} sayfa")
+
+    convert = lambda: stitch_tables(app.convert_pdf_tables(pdf_path))
+    print(f"{'Süreç':<8}{'En iyi (s)':>12}{'Ortalama (s)':>14}{'Hızlanma':>10}{'Satır':>8}  Aynı")
+    sequential_rows, sequential_best = None, None
+    for processes in [1] + [count for count in process_counts if count > 1]:
+        reset_conversion_executor(processes, pages_per_chunk)
+        # İlk çalıştırma model yüklemesini içerir, ölçüme katılmaz
+        convert()
+        df, best, avg = time_call(convert, repeat)
+        rows = normalized_rows(df)
+        if sequential_rows is None:
+            sequential_rows, sequential_best = rows, best
+        same = "evet" if rows == sequential_rows else "HAYIR"
+        print(f"{processes:<8}{best:>12.2f}{avg:>14.2f}{sequential_best / best:>9.1f}x{len(df):>8}  {same}")
+    reset_conversion_executor(1, pages_per_chunk)
+
+def compare_extractions(expected_df, actual_df):
+    """Satır düzeyinde kesinlik/duyarlılık ve sıralı hizalanmış satırlarda hücre doğruluğu"""
+    expected, actual = normalized_rows(expected_df), normalized_rows(actual_df)
+    matched = sum((Counter(expected) & Counter(actual)).values())
+    aligned = [(a, b) for a, b in zip(expected, actual) if len(a) == len(b)]
+    cells = sum(len(a) for a, _ in aligned)
+    same_cells = sum(x == y for a, b in aligned for x, y in zip(a, b))
+    return {
+        'precision': matched / len(actual) if actual else 1.0,
+        'recall': matched / len(expected) if expected else 1.0,
+        'cell_accuracy': same_cells / cells if cells else 1.0,
+        'identical': expected == actual,
+    }
+
+def benchmark_accuracy(pdf_paths, synthetic_pages, repeat):
+    """Metin katmanı hızlı yolunu docling çıktısıyla doğruluk ve süre açısından karşılaştırır"""
+    if synthetic_pages:
+        synthetic_file = os.path.join(BENCH_DIR, f"synthetic-{synthetic_pages}p.pdf")
+        make_synthetic_report(synthetic_file, synthetic_pages)
+        pdf_paths = list(pdf_paths) + [synthetic_file]
+
+    for pdf_path in pdf_paths:
+        print(f"\n{pdf_path}")
+        page_tables, text_best, _ = time_call(lambda: app.text_layer_tables(pdf_path), repeat)
+        fallback_pages = [page_num + 1 for page_num, tables in enumerate(page_tables) if tables is None]
+        text_df = stitch_tables([table for tables in page_tables if tables for table in tables])
+        print(f"  metin katmanı: {text_best * 1000:.1f} ms, {len(text_df)} satır, "
+              f"docling'e düşen sayfalar: {fallback_pages or 'yok'}")
+
+        try:
+            # İlk çalıştırma model yüklemesini içerir, ölçüme katılmaz
+            app.convert_pdf_tables(pdf_path)
+            docling_df, docling_best, _ = time_call(lambda: stitch_tables(app.convert_pdf_tables(pdf_path)), repeat)
+        except Exception as e:
+            print(f"  docling çalıştırılamadı: {e}")
+            continue
+        comparison = compare_extractions(docling_df, text_df)
+        print(f"  docling: {docling_best * 1000:.1f} ms, {len(docling_df)} satır "
+              f"(hızlanma {docling_best / max(text_best, 1e-9):.0f}x)")
+        print(f"  kesinlik {comparison['precision']:.3f}, duyarlılık {comparison['recall']:.3f}, "
+              f"hücre doğruluğu {comparison['cell_accuracy']:.3f}, "
+              f"birebir aynı: {'evet' if comparison['identical'] else 'hayır'}")
+
+def rerank_queries(limit):
+    """Her referans testi için arama sorgusu biçiminde yüksek ve düşük yönlü sorgular"""
+    _, lab_sections = get_reference_lookup()
+    return [
+        {'lab_name': lab_name, 'direction': direction, 'text': f"{lab_name} {status}"}
+        for lab_name in sorted(lab_sections)[:limit]
+        for direction, status in STATUS_LABELS.items()
+    ]
+
+def benchmark_rerank(query_limit, repeat, live, latency):
+    """Yerel hibrit sıralamayı Cohere ile gecikme ve sıralama uyumu açısından karşılaştırır"""
+    if live:
+        print("Gerçek Gemini, vektör indeksi ve Cohere kullanılıyor")
+    else:
+        install_stub_services(latency)
+        print("Sahte istemciler kullanılıyor: gecikmeler yapay, Cohere uyumu yalnızca vektör sırasını yansıtır "
+              "(gerçek karşılaştırma için --live)")
+
+    build_start = time.perf_counter()
+    get_lexical_index()
+    print(f"Sözcük indeksi: {(time.perf_counter() - build_start) * 1000:.1f} ms")
+
+    backend = get_retrieval_backend()
+    cohere = services.cohere()
+    rows = []
+    for query in rerank_queries(query_limit):
+        embedding = get_gemini_embedding(query['text'])
+        if embedding is None:
+            print("Gömme alınamadı; ölçüm durduruldu")
+            return
+        directions = {query['direction'], 'general'}
+        matches = [
+            match for match in backend.query(embedding, top_k=20)
+            if match['metadata'].get('direction', 'general') in directions
+        ]
+        if not matches:
+            continue
+
+        ranked, local_best, _ = time_call(lambda: hybrid_rerank(query['text'], matches, directions), repeat)
+        documents = [f"### {match['metadata']['lab_name']}\n{match['metadata']['content']}" for match in matches]
+        start = time.perf_counter()
+        response = cohere.rerank(model="rerank-v3.5", query=query['text'], documents=documents, top_n=10)
+        cohere_seconds = time.perf_counter() - start
+
+        local_order = [(metadata['lab_name'], metadata['content']) for _, metadata in ranked]
+        cohere_results = sorted(response.results, key=lambda result: -result.relevance_score)
+        cohere_order = [
+            (matches[result.index]['metadata']['lab_name'], matches[result.index]['metadata']['content'])
+            for result in cohere_results
+        ]
+        cohere_kept = {
+            key for key, result in zip(cohere_order, cohere_results) if result.relevance_score > app.COHERE_MIN_SCORE
+        }
+        union = cohere_kept | set(local_order)
+        rows.append({
+            'local_ms': local_best * 1000,
+            'cohere_ms': cohere_seconds * 1000,
+            'payload_kb': sum(len(document.encode('utf-8')) for document in documents) / 1024,
+            'top1_agree': bool(local_order and cohere_order and local_order[0] == cohere_order[0]),
+            'overlap_at_3': len(set(local_order[:3]) & set(cohere_order[:3])) / 3,
+            'kept_jaccard': len(cohere_kept & set(local_order)) / len(union) if union else 1.0,
+            'local_top1_lab': bool(local_order and local_order[0][0] == query['lab_name']),
+            'cohere_top1_lab': bool(cohere_order and cohere_order[0][0] == query['lab_name']),
+        })
+
+    if not rows:
+        print("Aday bölüm bulunan sorgu yok")
+        return
+
+    mean = lambda key: sum(row[key] for row in rows) / len(rows)
+    local_times = sorted(row['local_ms'] for row in rows)
+    print(f"{len(rows)} sorgu")
+    print(f"{'Sıralayıcı':<12}{'Ortalama (ms)':>15}{'p95 (ms)':>11}{'İlk sonuç doğru test':>24}")
+    print(f"{'yerel':<12}{mean('local_ms'):>15.3f}{local_times[int(0.95 * (len(rows) - 1))]:>11.3f}"
+          f"{mean('local_top1_lab'):>24.1%}")
+    cohere_times = sorted(row['cohere_ms'] for row in rows)
+    print(f"{'cohere':<12}{mean('cohere_ms'):>15.3f}{cohere_times[int(0.95 * (len(rows) - 1))]:>11.3f}"
+          f"{mean('cohere_top1_lab'):>24.1%}")
+    print(f"Sorgu başına Cohere'a giden metin: {mean('payload_kb'):.1f} KB")
+    print(f"Uyum: ilk sonuç {mean('top1_agree'):.1%}, ilk 3 örtüşme {mean('overlap_at_3'):.1%}, "
+          f"seçilen bölümler (Jaccard) {mean('kept_jaccard'):.1%}")
+
+# e-Nabız raporlarındaki gibi: ad, birim, alt ve üst sınır. Son üçünün referans dosyası yok, vektör aramasına düşer
+SYNTHETIC_TESTS = [
+    ("Alanin aminotransferaz (ALT)", "U/L", 5, 41),
+    ("Albümin", "g/L", 35, 52),
+    ("Alkalen fosfataz (ALP)", "U/L", 40, 129),
+    ("Aspartat transaminaz (AST)", "U/L", 5, 40),
+    ("Bilirubin (total)", "mg/dL", 0, 1.2),
+    ("C reaktif protein (CRP)", "mg/L", 0, 5),
+    ("Demir (serum)", "µg/dL", 33, 193),
+    ("Ferritin", "ng/mL", 30, 400),
+    ("Glukoz (Açlık Kan Şekeri)", "mg/dL", 74, 106),
+    ("HDL kolesterol", "mg/dL", 40, 60),
+    ("Hemoglobin (HGB)", "g/dL", 13.5, 17.5),
+    ("Hematokrit (HCT)", "%", 40, 52),
+    ("Kalsiyum (Ca)", "mg/dL", 8.6, 10),
+    ("Kreatinin", "mg/dL", 0.7, 1.2),
+    ("LDL kolesterol", "mg/dL", 0, 130),
+    ("Magnezyum", "mg/dL", 1.6, 2.6),
+    ("Potasyum (K)", "mmol/L", 3.5, 5.1),
+    ("Sodyum (Na)", "mmol/L", 136, 145),
+    ("Trigliserid", "mg/dL", 0, 200),
+    ("Ortalama eritrosit hacmi (MCV)", "fL", 80, 100),
+    ("Homosistein", "µmol/L", 5, 15),
+    ("Fibrinojen", "mg/dL", 200, 400),
+    ("Seruloplazmin", "mg/dL", 20, 60),
+]
+SYNTHETIC_QUALITATIVE = [
+    ("Nitrit", "Negatif"),
+    ("Keton", "Negatif"),
+    ("Bakteri", "Negatif"),
+]
+SYNTHETIC_COLUMNS = ["Tarih", "Tahlil", "Sonuç", "Sonuç Birimi", "Referans Değeri"]
+COLUMN_EDGES = [36, 116, 326, 396, 486, 576]
+ROW_HEIGHT = 16
+TABLE_TOP = 90
+
+def format_number(value):
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+def synthetic_rows(pages, rows_per_page, abnormal_ratio=0.2, seed=0):
+    """Her sayfa için rapor satırları üretir; değerlerin bir kısmı bilerek referans dışındadır"""
+    rng = random.Random(seed)
+    report_pages = []
+    for page_num in range(pages):
+        date = f"{1 + page_num % 28:02d}.08.2025 15:51"
+        rows = []
+        for row_num in range(rows_per_page):
+            if row_num % 10 == 9:
+                name, result = SYNTHETIC_QUALITATIVE[row_num // 10 % len(SYNTHETIC_QUALITATIVE)]
+                rows.append(["-", name, result, "", "Negatif"])
+                continue
+            name, unit, low, high = SYNTHETIC_TESTS[rng.randrange(len(SYNTHETIC_TESTS))]
+            span = high - low
+            if rng.random() < abnormal_ratio:
+                value = high + span * rng.uniform(0.1, 0.5) if rng.random() < 0.5 else max(0, low - span * rng.uniform(0.1, 0.5))
+            else:
+                value = rng.uniform(low, high)
+            rows.append([date, name, format_number(value), unit, f"{format_number(low)} - {format_number(high)}"])
+        report_pages.append(rows)
+    return report_pages
+
+def make_synthetic_report(pdf_path, pages=1, rows_per_page=30, seed=0):
+    """e-Nabız tahlil çıktısına benzeyen, çizgili tablolu sentetik bir PDF yazar ve sayfa satırlarını döndürür"""
+    report_pages = synthetic_rows(pages, rows_per_page, seed=seed)
+    font = fitz.Font("helv")
+    doc = fitz.open()
+    for rows in report_pages:
+        page = doc.new_page(width=612, height=max(792, TABLE_TOP + (len(rows) + 2) * ROW_HEIGHT))
+        writer = fitz.TextWriter(page.rect)
+        writer.append((COLUMN_EDGES[0], 50), "Adı Soyadı: ", font=font, fontsize=10)
+        writer.append((COLUMN_EDGES[0], 66), "Tarih: 12.09.2025", font=font, fontsize=10)
+
+        table_rows = [SYNTHETIC_COLUMNS] + rows
+        for row_num, cells in enumerate(table_rows):
+            y = TABLE_TOP + row_num * ROW_HEIGHT
+            for x, cell in zip(COLUMN_EDGES, cells):
+                writer.append((x + 3, y + ROW_HEIGHT - 4), str(cell), font=font, fontsize=8)
+        writer.write_text(page)
+
+        # Izgara çizgileri tablo algılayıcılarının hücreleri bulmasını sağlar
+        bottom = TABLE_TOP + len(table_rows) * ROW_HEIGHT
+        shape = page.new_shape()
+        for row_num in range(len(table_rows) + 1):
+            y = TABLE_TOP + row_num * ROW_HEIGHT
+            shape.draw_line((COLUMN_EDGES[0], y), (COLUMN_EDGES[-1], y))
+        for x in COLUMN_EDGES:
+            shape.draw_line((x, TABLE_TOP), (x, bottom))
+        shape.finish(color=(0, 0, 0), width=0.5)
+        shape.commit()
+
+    doc.save(pdf_path)
+    doc.close()
+    return report_pages
+
+def write_synthetic_markdown(report_pages, markdown_file):
+    """Docling'in tablo dışa aktarımıyla aynı biçimde, her sayfa için başlıklı bir markdown tablosu yazar"""
+    with open(markdown_file, 'w', encoding='utf-8') as f:
+        for rows in report_pages:
+            f.write("| " + " | ".join(SYNTHETIC_COLUMNS) + " |\n")
+            f.write("|" + "---|" * len(SYNTHETIC_COLUMNS) + "\n")
+            for cells in rows:
+                f.write("| " + " | ".join(cells) + " |\n")
+            f.write("\n")
+
+def fake_embedding(text):
+    """Metne göre sabit, ağ gerektirmeyen bir vektör"""
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'big')
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSION).astype(np.float32).tolist()
+
+class StubGemini:
+    """Gemini istemcisinin gömme arayüzünü yapay gecikmeyle taklit eder"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.models = self
+
+    def embed_content(self, model, contents, config=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=fake_embedding(text)) for text in contents])
+
+class StubPineconeIndex:
+    def __init__(self, matches, latency):
+        self.matches = matches
+        self.latency = latency
+        self.calls = 0
+
+    def query(self, vector, top_k, include_metadata=True, timeout=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'matches': self.matches[:top_k]}
+
+    def upsert(self, vectors, timeout=None):
+        time.sleep(self.latency)
+
+    def delete(self, ids=None, delete_all=False, timeout=None):
+        time.sleep(self.latency)
+
+class StubPinecone:
+    """Referans bölümlerini sabit sırayla döndüren sahte Pinecone"""
+
+    def __init__(self, latency):
+        _, lab_sections = get_reference_lookup()
+        matches = [
+            {
+                'id': f"{lab_name}-{i}",
+                'score': 1.0,
+                'metadata': {
+                    'lab_name': lab_name,
+                    'direction': section['direction'],
+                    'section': section['kind'],
+                    'content': section['text'],
+                },
+            }
+            for lab_name, sections in sorted(lab_sections.items())
+            for i, section in enumerate(sections)
+        ]
+        self.index = StubPineconeIndex(matches, latency)
+
+    def list_indexes(self):
+        return SimpleNamespace(names=lambda: [LAB_INDEX_NAME])
+
+    def Index(self, name):
+        return self.index
+
+class StubCohere:
+    """Belgeleri sırasıyla azalan puanlarla yeniden sıralar"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def rerank(self, model, query, documents, top_n):
+        self.calls += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(results=[
+            SimpleNamespace(index=i, relevance_score=0.95 - 0.05 * i)
+            for i in range(min(top_n, len(documents)))
+        ])
+
+def install_stub_services(latency):
+    services.register('gemini', client=StubGemini(latency))
+    services.register('pinecone', client=StubPinecone(latency))
+    services.register('cohere', client=StubCohere(latency))
+
+def cold_embedding_cache():
+    """Her tekrar aynı koşulda ölçülsün diye boş bir gömme önbelleğiyle başlar"""
+    path = os.path.join(BENCH_DIR, f"embeddings-{time.perf_counter_ns()}.sqlite")
+    app.embedding_cache = EmbeddingCache(path, app.EMBEDDING_CACHE_MAX_BYTES)
+
+def cold_extraction_cache():
+    app.EXTRACTION_CACHE_DIR = os.path.join(BENCH_DIR, f"extraction-{time.perf_counter_ns()}")
+
+def benchmark_size(pages, rows_per_page, repeat, measure_memory, include_docling):
+    """Tek bir rapor boyutu için her aşamayı ayrı ayrı ölçer"""
+    pdf_file = os.path.join(BENCH_DIR, f"synthetic-{pages}p.pdf")
+    markdown_file = os.path.join(BENCH_DIR, f"synthetic-{pages}p.md")
+    report_pages = make_synthetic_report(pdf_file, pages, rows_per_page)
+    write_synthetic_markdown(report_pages, markdown_file)
+
+    df = markdown_to_dataframe(markdown_file)
+    abnormal_values = detect_abnormal_values(df)
+    relevant_references = get_relevant_references(abnormal_values)
+
+    stages = [('get_pdf_pages', lambda: get_pdf_pages(pdf_file), None)]
+    if include_docling:
+        cold_extraction_cache()
+        extracted, message = process_pdf(pdf_file)
+        if extracted.empty:
+            # Modeller indirilemediğinde hata süresini ölçmenin anlamı yok
+            print(f"process_pdf atlanıyor: {message}")
+        else:
+            stages.append(('process_pdf', lambda: process_pdf(pdf_file), cold_extraction_cache))
+    stages += [
+        ('markdown_to_dataframe', lambda: markdown_to_dataframe(markdown_file), None),
+        ('detect_abnormal_values', lambda: detect_abnormal_values(df), None),
+        ('get_relevant_references', lambda: get_relevant_references(abnormal_values), cold_embedding_cache),
+        ('prompt_assembly', lambda: compact_analysis_prompt(df, relevant_references), None),
+    ]
+
+    results = {}
+    for name, fn, setup in stages:
+        _, best, avg = time_call(fn, repeat, setup)
+        results[name] = {'best_ms': round(best * 1000, 3), 'avg_ms': round(avg * 1000, 3)}
+        if measure_memory:
+            results[name]['peak_kb'] = round(peak_memory(fn, setup), 1)
+    return results, {'rows': len(df), 'abnormal': len(abnormal_values)}
+
+def scaling_exponent(sizes, timings):
+    """log-log eğimi: ~1 doğrusal, belirgin şekilde 1'in üstü süper doğrusal büyüme demektir"""
+    points = [(size, timing) for size, timing in zip(sizes, timings) if size > 0 and timing > 0]
+    if len(points) < 2:
+        return None
+    x, y = np.log([p[0] for p in points]), np.log([p[1] for p in points])
+    return float(np.polyfit(x, y, 1)[0])
+
+def print_report(results, sizes, workload):
+    print(f"{'Aşama':<26}{'Sayfa':>7}{'Satır':>8}{'En iyi (ms)':>14}{'Ortalama (ms)':>16}{'Tepe (KB)':>12}")
+    for stage in results:
+        for size in sizes:
+            entry = results[stage].get(str(size))
+            if entry is None:
+                continue
+            peak = f"{entry['peak_kb']:>12.1f}" if 'peak_kb' in entry else f"{'-':>12}"
+            print(f"{stage:<26}{size:>7}{workload[str(size)]['rows']:>8}"
+                  f"{entry['best_ms']:>14.2f}{entry['avg_ms']:>16.2f}{peak}")
+        exponent = scaling_exponent(sizes, [results[stage][str(size)]['best_ms'] for size in sizes])
+        if exponent is not None:
+            print(f"{'':<26}ölçeklenme üssü: {exponent:.2f}")
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Süre veya bellek, temel ölçümün tolerans katını aşan aşamaları döndürür"""
+    regressions = []
+    for stage, sizes in results.items():
+        for size, entry in sizes.items():
+            reference = baseline.get('results', {}).get(stage, {}).get(size)
+            if not reference:
+                continue
+            for metric in ('best_ms', 'peak_kb'):
+                if metric in entry and reference.get(metric) and entry[metric] > reference[metric] * tolerance:
+                    regressions.append((stage, size, metric, reference[metric], entry[metric]))
+    return regressions
+
+def run_suite(args):
+    sizes = sorted({int(size) for size in args.pages.split(',')})
+    include_docling = not args.skip_docling and importlib.util.find_spec("docling") is not None
+    if not include_docling:
+        print("process_pdf atlanıyor (docling yüklü değil veya --skip-docling verildi)")
+
+    install_stub_services(args.latency_ms / 1000)
+    settings = {
+        'rows_per_page': args.rows_per_page,
+        'latency_ms': args.latency_ms,
+        'repeat': args.repeat,
+    }
+
+    results, workload = {}, {}
+    for size in sizes:
+        print(f"{size} sayfa ölçülüyor...", flush=True)
+        size_results, workload[str(size)] = benchmark_size(
+            size, args.rows_per_page, args.repeat, not args.no_memory, include_docling
+        )
+        for stage, entry in size_results.items():
+            results.setdefault(stage, {})[str(size)] = entry
+
+    print()
+    print_report(results, sizes, workload)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'settings': settings,
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\nTemel ölçüm kaydedildi: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != settings:
+        print(f"\nUyarı: {args.baseline} farklı ayarlarla alınmış ({baseline.get('settings')}); karşılaştırma yapılmadı")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if not regressions:
+        print(f"\nTemel ölçüme göre gerileme yok ({args.baseline}, tolerans {args.tolerance}x)")
+        return 0
+
+    print(f"\nGerileme bulundu ({args.baseline}, tolerans {args.tolerance}x):")
+    for stage, size, metric, before, after in regressions:
+        print(f"  {stage} [{size} sayfa] {metric}: {before} -> {after}")
+    return 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Publica performans ölçümleri")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extraction = subparsers.add_parser("extraction", help="Çıkarma yolu karşılaştırması (docling gerekir)")
+    extraction.add_argument("pdf", nargs="?", default="Enabiz-Tahlilleri.pdf")
+    extraction.add_argument("--repeat", type=int, default=20)
+
+    accuracy = subparsers.add_parser("accuracy", help="Metin katmanı çıkarımının docling'e göre doğruluğu")
+    accuracy.add_argument("pdfs", nargs="*", default=["Enabiz-Tahlilleri.pdf"])
+    accuracy.add_argument("--synthetic-pages", type=int, default=10, help="0 verilirse sentetik rapor eklenmez")
+    accuracy.add_argument("--repeat", type=int, default=3)
+
+    parallel = subparsers.add_parser("parallel", help="Sayfa paralel dönüşüm ölçeklenmesi (docling gerekir)")
+    parallel.add_argument("pdf", nargs="?", default=None, help="Verilmezse sentetik rapor üretilir")
+    parallel.add_argument("--pages", type=int, default=32, help="Sentetik raporun sayfa sayısı")
+    parallel.add_argument("--processes", default="1,2,4", help="Virgülle ayrılmış süreç sayıları")
+    parallel.add_argument("--pages-per-chunk", type=int, default=app.PDF_PAGES_PER_CHUNK)
+    parallel.add_argument("--repeat", type=int, default=3)
+
+    rerank = subparsers.add_parser("rerank", help="Yerel hibrit sıralama ile Cohere karşılaştırması")
+    rerank.add_argument("--queries", type=int, default=40, help="Sorgu üretilecek referans testi sayısı")
+    rerank.add_argument("--repeat", type=int, default=20)
+    rerank.add_argument("--live", action="store_true", help="Sahte istemciler yerine .env'deki gerçek servisleri kullan")
+    rerank.add_argument("--latency-ms", type=float, default=50, help="Sahte Gemini/Pinecone/Cohere çağrı gecikmesi")
+
+    suite = subparsers.add_parser("suite", help="Ağ gerektirmeyen, aşama aşama ölçüm paketi")
+    suite.add_argument("--pages", default="1,10,50,200", help="Virgülle ayrılmış sentetik rapor sayfa sayıları")
+    suite.add_argument("--rows-per-page", type=int, default=30)
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--latency-ms", type=float, default=50, help="Sahte Gemini/Pinecone/Cohere çağrı gecikmesi")
+    suite.add_argument("--no-memory", action="store_true", help="tracemalloc ile tepe bellek ölçümünü atla")
+    suite.add_argument("--skip-docling", action="store_true")
+    suite.add_argument("--baseline", default=DEFAULT_BASELINE_FILE)
+    suite.add_argument("--save-baseline", action="store_true", help="Sonuçları temel ölçüm olarak kaydet")
+    suite.add_argument("--tolerance", type=float, default=1.5, help="Gerileme sayılacak temel ölçüm katı")
+
+    args = parser.parse_args()
+    if args.command == "extraction":
+        benchmark_extraction(args.pdf, args.repeat)
+    elif args.command == "accuracy":
+        benchmark_accuracy(args.pdfs, args.synthetic_pages, args.repeat)
+    elif args.command == "rerank":
+        benchmark_rerank(args.queries, args.repeat, args.live, args.latency_ms / 1000)
+    elif args.command == "parallel":
+        process_counts = sorted({int(count) for count in args.processes.split(',')})
+        benchmark_parallel(args.pdf, args.pages, process_counts, args.pages_per_chunk, args.repeat)
+    else:
+        sys.exit(run_suite(args))
+
+if __name__ == "__main__":
+    main()